@@ -0,0 +1,53 @@
+"""Замер полного бэкапа в зависимости от числа параллельных соединений.
+
+Запуск (нужны TELEGRAM_TOKEN и DATABASE_URL, как для самого бота):
+    python benchmarks/bench_backup.py [воркеры через запятую] [повторов]
+    python benchmarks/bench_backup.py 1,2,4 3
+
+Бэкапы пишутся во временный каталог и удаляются; база только читается
+(record=False: цепочка инкрементов и индекс бэкапов не меняются).
+Соединений не больше main.BACKUP_POOL_HEADROOM — для замера больших значений
+увеличьте DB_POOL_MAX.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main
+
+
+def bench():
+    workers_list = [int(w) for w in (sys.argv[1] if len(sys.argv) > 1 else '1,2,4').split(',')]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with main.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM reputation)')
+        users, reps = cursor.fetchone()
+    print(f"База: {users} пользователей, {reps} отзывов; кусок reputation: {main.BACKUP_CHUNK_ROWS} строк")
+    print(f"Запас пула для параллельной выгрузки: {main.BACKUP_POOL_HEADROOM} соединений")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for workers in workers_list:
+            timings = []
+            for i in range(repeats):
+                filepath = os.path.join(tmp_dir, f"bench_{workers}_{i}.tar")
+                started = time.perf_counter()
+                manifest = main.backup_manager.dump_to_file(filepath, workers=workers, record=False)
+                timings.append(time.perf_counter() - started)
+                os.remove(filepath)
+
+            print(
+                f"воркеров: {min(workers, main.BACKUP_POOL_HEADROOM) or 1:<2}  лучшее {min(timings):.2f} с, "
+                f"среднее {sum(timings) / len(timings):.2f} с, "
+                f"файл {manifest['size'] / (1024 * 1024):.1f} MB"
+            )
+
+    main.shutdown_db()
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,92 @@
+"""Замер разбора команд репутации: прежние регулярки по очереди против rep_parser.
+
+Запуск (база и токен не нужны):
+    python benchmarks/bench_parser.py [сообщений] [файл_корпуса]
+
+Корпус по умолчанию — benchmarks/data/group_messages.txt (по сообщению на строку,
+строки с # пропускаются). Кроме времени скрипт печатает сообщения, которые прежний
+и новый разбор понимают по-разному.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rep_parser import parse_reputation
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'group_messages.txt')
+
+# Прежний разбор из main.py: проверка команды, знак и четыре шаблона цели
+REP_PATTERN = re.compile(r'[+-][\s:;-]*(?:rep|реп|рп)(?:\s|$|[^a-za-zа-я0-9])', re.IGNORECASE)
+
+
+def parse_old(text):
+    """Прежний путь: (знак, цель) или None"""
+    if not (bool(REP_PATTERN.search(text)) if text else False):
+        return None
+
+    match = REP_PATTERN.search(text.lower())
+    polarity = match.group(0)[0] if match else None
+
+    patterns = [
+        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*@?([a-zA-Z0-9_]+)',
+        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*(\d+)',
+        r'@?([a-zA-Z0-9_]+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
+        r'(\d+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
+    ]
+    target = None
+    for pattern in patterns:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            target = match.group(1)
+            break
+    return polarity, target
+
+
+def parse_new(text):
+    """Новый путь в том же виде: (знак, цель) или None"""
+    command = parse_reputation(text)
+    if command is None:
+        return None
+    target = command.username if command.user_id is None else str(command.user_id)
+    return command.polarity, target
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip() and not line.startswith('#')]
+
+
+def run(func, messages):
+    """Разобрать все сообщения, вернуть затраченное время"""
+    started = time.perf_counter()
+    for text in messages:
+        func(text)
+    return time.perf_counter() - started
+
+
+def bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    corpus = load_corpus(sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CORPUS)
+    messages = (corpus * (count // len(corpus) + 1))[:count]
+
+    commands = sum(1 for text in corpus if parse_new(text))
+    print(f"Корпус: {len(corpus)} сообщений, команд репутации: {commands}; замер на {count} сообщениях")
+
+    for label, func in (("по очереди (было)", parse_old), ("rep_parser (стало)", parse_new)):
+        # Прогрев: компиляция шаблонов в кэше re
+        run(func, corpus)
+        elapsed = run(func, messages)
+        print(f"{label:<22} {elapsed:.3f} с, {elapsed / count * 1e6:.2f} мкс/сообщение")
+
+    differences = [(text, parse_old(text), parse_new(text)) for text in corpus]
+    differences = [item for item in differences if item[1] != item[2]]
+    print(f"\nРазбор отличается в {len(differences)} сообщениях:")
+    for text, old, new in differences:
+        print(f"  {text!r}: было {old}, стало {new}")
+
+
+if __name__ == '__main__':
+    bench()
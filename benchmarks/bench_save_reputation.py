@@ -0,0 +1,91 @@
+"""Замер пути сохранения отзыва: три транзакции (как было) против одной.
+
+Запуск (нужны TELEGRAM_TOKEN и DATABASE_URL, как для самого бота):
+    python benchmarks/bench_save_reputation.py [количество_отзывов]
+
+Скрипт пишет отзывы от/для пользователей с ID из служебного диапазона
+и удаляет их за собой.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main
+
+BENCH_USER_BASE = 9_000_000_000
+
+
+def save_reputation_three_transactions(from_user, from_username, to_user, to_username, text, photo_id):
+    """Прежний путь: save_user дважды и отдельная транзакция на отзыв"""
+    main.save_user(from_user, from_username)
+    main.save_user(to_user, to_username)
+
+    with main.db_connection() as conn:
+        cursor = conn.cursor()
+        polarity = main.get_reputation_polarity(text)
+        cursor.execute('''
+            INSERT INTO reputation (from_user, to_user, text, photo_id, created_at, polarity)
+            VALUES (%s, %s, %s, %s, NOW(), %s)
+            RETURNING id
+        ''', (from_user, to_user, text, photo_id, polarity))
+        rep_id = cursor.fetchone()[0]
+        main.update_reputation_counters(cursor, to_user, polarity, 1, rep_id)
+        conn.commit()
+    main.profile_cache.invalidate(to_user)
+
+
+def run(func, count):
+    """Сохранить count отзывов, вернуть затраченное время"""
+    started = time.perf_counter()
+    for i in range(count):
+        func(BENCH_USER_BASE + i % 50, f"bench_from_{i % 50}",
+             BENCH_USER_BASE + 100 + i % 20, f"bench_to_{i % 20}",
+             f"+rep @bench_to_{i % 20} бенчмарк", None)
+    return time.perf_counter() - started
+
+
+def cleanup():
+    with main.db_connection() as conn:
+        cursor = conn.cursor()
+        user_range = (BENCH_USER_BASE, BENCH_USER_BASE + 1000)
+        cursor.execute('DELETE FROM reputation WHERE to_user BETWEEN %s AND %s', user_range)
+        cursor.execute('DELETE FROM reputation_counters WHERE user_id BETWEEN %s AND %s', user_range)
+        cursor.execute('DELETE FROM reputation_daily WHERE user_id BETWEEN %s AND %s', user_range)
+        cursor.execute('DELETE FROM users WHERE user_id BETWEEN %s AND %s', user_range)
+        conn.commit()
+
+
+def bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    if not main.init_db():
+        sys.exit(1)
+
+    # Прогрев пула соединений
+    main.check_database_connection()
+
+    # Печать из save_user/save_reputation здесь только мешает
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    try:
+        for label, func in (
+            ("3 транзакции (было)", save_reputation_three_transactions),
+            ("1 транзакция (стало)", main.save_reputation),
+        ):
+            sys.stdout = devnull
+            try:
+                elapsed = run(func, count)
+            finally:
+                sys.stdout = stdout
+            print(f"{label:<28} {count} отзывов: {elapsed:.3f} с, {elapsed / count * 1000:.2f} мс/отзыв")
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        cleanup()
+        main.shutdown_db()
+
+
+if __name__ == '__main__':
+    bench()
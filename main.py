@@ -1,11 +1,27 @@
 import os
 import re
 import sys
+import time
+import asyncio
+import functools
+import threading
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
+import io
 import glob
 import gzip
-from datetime import datetime
+import hashlib
+import json
+import tarfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ReplyKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -15,6 +31,8 @@ from telegram.ext import (
     filters
 )
 
+from rep_parser import parse_reputation
+
 # ========== НАСТРОЙКИ ==========
 TOKEN = os.environ.get('TELEGRAM_TOKEN')
 if not TOKEN:
@@ -26,6 +44,54 @@ if not DATABASE_URL:
     print("❌ ОШИБКА: DATABASE_URL не найден!")
     sys.exit(1)
 
+# Часовой пояс для отображения дат (и для старых дат, сохранённых без пояса)
+BOT_TIMEZONE = os.environ.get('BOT_TIMEZONE', 'UTC')
+BOT_TZ = ZoneInfo(BOT_TIMEZONE)
+
+# Параллельная выгрузка бэкапа: соединений в общем снимке (не больше запаса пула БД); 1 — последовательно
+BACKUP_WORKERS = int(os.environ.get('BACKUP_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Пул соединений PostgreSQL: по умолчанию 10 на потоки запросов и бэкапов плюс соединения параллельной выгрузки
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', str(10 + BACKUP_WORKERS)))
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', '30'))  # секунд простоя до проверки SELECT 1
+
+# Потоки для запросов к БД из асинхронных хендлеров (в сумме не больше DB_POOL_MAX)
+DB_WORKERS = int(os.environ.get('DB_WORKERS', '6'))
+DB_HEAVY_WORKERS = int(os.environ.get('DB_HEAVY_WORKERS', '2'))
+
+# Кэш карточек профиля
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '1000'))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '60'))  # секунд
+
+# Пакетная запись пользователей из сообщений групп
+USER_FLUSH_INTERVAL = float(os.environ.get('USER_FLUSH_INTERVAL', '0.3'))  # секунд
+KNOWN_USERS_LIMIT = int(os.environ.get('KNOWN_USERS_LIMIT', '50000'))
+
+# Топы: снимки пересчитываются фоновой задачей JobQueue
+LEADERBOARD_REFRESH_INTERVAL = float(os.environ.get('LEADERBOARD_REFRESH_INTERVAL', '300'))  # секунд
+LEADERBOARD_SIZE = 15
+
+# Рассылка: общий лимит Telegram ~30 сообщений в секунду
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))  # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_BATCH_SIZE = 100  # получателей между сохранениями прогресса
+
+# Автоматические бэкапы (BACKUP_INTERVAL_HOURS=0 — выключены)
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', '6'))
+BACKUP_FULL_INTERVAL_HOURS = float(os.environ.get('BACKUP_FULL_INTERVAL_HOURS', '24'))  # между ними — инкременты
+# Размер куска reputation по диапазону id: куски выгружаются параллельно
+BACKUP_CHUNK_ROWS = int(os.environ.get('BACKUP_CHUNK_ROWS', '50000'))
+# Уровень gzip: 6 почти не уступает 9 по размеру и заметно быстрее
+BACKUP_COMPRESSLEVEL = int(os.environ.get('BACKUP_COMPRESSLEVEL', '6'))
+# Хранение «дед-отец-сын»: последний полный бэкап каждого из N дней, недель и месяцев
+BACKUP_KEEP_DAILY = int(os.environ.get('BACKUP_KEEP_DAILY', '7'))
+BACKUP_KEEP_WEEKLY = int(os.environ.get('BACKUP_KEEP_WEEKLY', '4'))
+BACKUP_KEEP_MONTHLY = int(os.environ.get('BACKUP_KEEP_MONTHLY', '6'))
+# Проверка последнего бэкапа восстановлением во временную схему (0 — выключена)
+BACKUP_VERIFY_INTERVAL_HOURS = float(os.environ.get('BACKUP_VERIFY_INTERVAL_HOURS', '24'))
+BACKUP_PROGRESS_INTERVAL = 3  # секунд между обновлениями сообщения о прогрессе
+
 PHOTO_URL = "https://raw.githubusercontent.com/sgafa49-png/tess-reputation-bot/main/IMG_0354.jpeg"
 ADMINS = [8438564254, 7819922804]  # ID админов
 
@@ -41,7 +107,7 @@ def get_admin_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['Удалить отзыв'],
         ['Статистика', 'Рассылка'],
-        ['Топ по репутации'],
+        ['Топ по репутации', 'Пересчитать репутацию'],
         ['Резервное копирование'],
         ['Главное меню']
     ], resize_keyboard=True, one_time_keyboard=False)
@@ -49,9 +115,9 @@ def get_admin_menu_keyboard():
 def get_backup_menu_keyboard():
     """Меню резервного копирования"""
     return ReplyKeyboardMarkup([
-        ['Создать бэкап'],
+        ['Создать бэкап', 'Инкрементальный бэкап'],
         ['Показать бэкапы', 'Восстановить'],
-        ['Автоочистка'],
+        ['Проверить бэкап', 'Автоочистка'],
         ['Назад в админ-панель']
     ], resize_keyboard=True, one_time_keyboard=False)
 
@@ -64,52 +130,285 @@ def get_top_menu_keyboard():
     ], resize_keyboard=True, one_time_keyboard=False)
 
 # ========== КОНСТАНТЫ ДЛЯ РЕПУТАЦИИ ==========
-REP_PATTERN = re.compile(r'[+-][\s:;-]*(?:rep|реп|рп)(?:\s|$|[^a-za-zа-я0-9])', re.IGNORECASE)
-
-def is_reputation_command(text):
-    """Определяет, является ли сообщение командой репутации"""
-    return bool(REP_PATTERN.search(text)) if text else False
-
 def get_reputation_type(text):
     """Определяет тип репутации: + (positive) или - (negative)"""
-    if not text:
-        return None
-    
-    text_lower = text.lower()
-    match = REP_PATTERN.search(text_lower)
-    if match:
-        start_pos = match.start()
-        if start_pos < len(text_lower):
-            char = text_lower[start_pos]
-            if char in '+-':
-                return '+' if char == '+' else '-'
-    return None
+    command = parse_reputation(text)
+    return command.polarity if command else None
+
+def format_datetime(value, fmt):
+    """Дата из БД (timestamptz или старая ISO-строка) в часовом поясе бота"""
+    if not value:
+        return "—"
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=BOT_TZ)
+    return value.astimezone(BOT_TZ).strftime(fmt)
+
+def get_reputation_polarity(text):
+    """Полярность отзыва для колонки reputation.polarity: '+', '-' или '0' (не определена)"""
+    return get_reputation_type(text) or '0'
 
 # ========== БАЗА ДАННЫХ POSTGRESQL ==========
-def get_db_connection():
-    """Возвращает соединение с PostgreSQL"""
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        return conn
-    except Exception as e:
-        print(f"❌ Ошибка подключения PostgreSQL: {e}")
-        sys.exit(1)
+class DatabasePool:
+    """Общий пул соединений PostgreSQL с проверкой соединения при выдаче"""
 
-def init_db():
-    """Инициализация базы данных"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
+    def __init__(self, dsn, minconn, maxconn, ping_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.ping_interval = ping_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        # Ограничивает число одновременно выданных соединений: при исчерпании пула ждём, а не падаем
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn, sslmode='require'
+                    )
+                    print(f"✅ Пул соединений PostgreSQL: {self.minconn}-{self.maxconn}")
+        return self._pool
+
+    def _is_alive(self, conn):
+        """Проверка соединения перед выдачей"""
+        if conn.closed:
+            return False
+
+        # Соединение, которое недавно работало, не пингуем лишний раз
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.ping_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        pool = self._get_pool()
+
+        # Битые соединения выбрасываем и берём новые (не больше maxconn попыток)
+        for _ in range(self.maxconn + 1):
+            conn = pool.getconn()
+            if self._is_alive(conn):
+                return conn
+            print("⚠️ Соединение PostgreSQL потеряно, переподключаемся")
+            self._last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+
+        raise psycopg2.OperationalError("Не удалось получить рабочее соединение из пула")
+
+    def _release(self, conn, broken=False):
+        pool = self._pool
+        if broken or conn.closed:
+            self._last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            return
+
+        # Незавершённая транзакция не должна вернуться в пул
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        self._last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn)
+
+    @contextmanager
+    def connection(self):
+        """Выдать соединение из пула: with db_pool.connection() as conn"""
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            try:
+                self._release(conn, broken)
+            finally:
+                self._slots.release()
+
+    def close(self):
+        """Закрыть все соединения пула"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_PING_INTERVAL)
+
+def db_connection():
+    """Соединение из общего пула (контекстный менеджер)"""
+    return db_pool.connection()
+
+# ========== АСИНХРОННЫЙ ДОСТУП К БД ==========
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+# Топы, статистика и рассылки идут в отдельный пул, чтобы тяжёлый запрос не занимал потоки быстрых
+DB_HEAVY_EXECUTOR = ThreadPoolExecutor(max_workers=DB_HEAVY_WORKERS, thread_name_prefix='db-heavy')
+# Бэкапы: выгрузка, сжатие, восстановление и работа с файлами — в своём пуле, не занимая потоки запросов
+BACKUP_IO_WORKERS = 2
+BACKUP_EXECUTOR = ThreadPoolExecutor(max_workers=BACKUP_IO_WORKERS, thread_name_prefix='backup-io')
+# Соединения пула, которые не могут занять потоки запросов и бэкапов: только их берут
+# дополнительные соединения параллельной выгрузки, иначе запросы бота ждали бы слота
+BACKUP_POOL_HEADROOM = max(0, DB_POOL_MAX - DB_WORKERS - DB_HEAVY_WORKERS - BACKUP_IO_WORKERS)
+
+async def run_db(func, *args, **kwargs):
+    """Выполнить функцию БД в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def run_db_heavy(func, *args, **kwargs):
+    """Выполнить тяжёлый запрос (топы, статистика) в отдельном пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_HEAVY_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def run_backup_io(func, *args, **kwargs):
+    """Выполнить работу с файлами бэкапов (и их выгрузку из БД) в пуле потоков бэкапов"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BACKUP_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+def shutdown_db():
+    """Дождаться запросов в потоках и закрыть пул соединений"""
+    DB_EXECUTOR.shutdown(wait=True)
+    DB_HEAVY_EXECUTOR.shutdown(wait=True)
+    BACKUP_EXECUTOR.shutdown(wait=True)
+    db_pool.close()
+
+# ========== СХЕМА БАЗЫ ДАННЫХ ==========
+def concurrent_index(name, definition):
+    """Шаг миграции: CREATE INDEX CONCURRENTLY, не блокирующий запись в живую таблицу"""
+    def step():
+        with db_connection() as conn:
+            # CONCURRENTLY нельзя выполнять внутри транзакции
+            conn.autocommit = True
+            try:
+                cursor = conn.cursor()
+
+                # Прерванный CONCURRENTLY оставляет невалидный индекс — удаляем и строим заново
+                cursor.execute(
+                    'SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)',
+                    (name,)
+                )
+                row = cursor.fetchone()
+                if row and row[0]:
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+                cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}')
+            finally:
+                conn.autocommit = False
+
+    return step
+
+# Старая TEXT-дата в TIMESTAMPTZ. Значения без пояса писались datetime.now() — считаем их временем tz.
+# Нераспознанная дата становится NULL (её обработает миграция 7), а не обрывает всю миграцию.
+# Функция во временной схеме сеанса: в базе после миграции ничего не остаётся
+LEGACY_TIMESTAMPTZ_FUNCTION = r'''
+    CREATE OR REPLACE FUNCTION pg_temp.legacy_timestamptz(value TEXT, tz TEXT) RETURNS TIMESTAMPTZ
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF value IS NULL OR value !~ '^\d{4}-\d{2}-\d{2}' THEN
+            RETURN NULL;
+        END IF;
+        IF value ~ '\d{2}:\d{2}(:\d{2}(\.\d+)?)?([+-]\d{2}(:?\d{2})?|Z)$' THEN
+            RETURN value::timestamptz;
+        END IF;
+        RETURN value::timestamp AT TIME ZONE tz;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$
+'''
+
+def migrate_to_timestamptz(table, column, key):
+    """Шаг миграции: перевод TEXT-колонки с ISO-датой в TIMESTAMPTZ без долгой блокировки таблицы"""
+    new_column = f"{column}_tz"
+    converted = f"pg_temp.legacy_timestamptz({column}, %(tz)s)"
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s',
+            (table, column)
+        )
+        row = cursor.fetchone()
+        if row and row[0] == 'timestamp with time zone':
+            return
+
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new_column} TIMESTAMPTZ')
+        conn.commit()
+
+    # Бэкфилл пачками: каждая пачка — короткая транзакция, запись в таблицу не блокируется
+    last_key = None
+    while True:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(LEGACY_TIMESTAMPTZ_FUNCTION)
+            key_filter = f"AND {key} > %(last_key)s" if last_key is not None else ""
+            cursor.execute(f"""
+                WITH batch AS (
+                    SELECT {key} FROM {table}
+                    WHERE {new_column} IS NULL {key_filter}
+                    ORDER BY {key}
+                    LIMIT %(batch_size)s
+                )
+                UPDATE {table} t SET {new_column} = {converted}
+                FROM batch WHERE t.{key} = batch.{key}
+                RETURNING t.{key}
+            """, {'tz': BOT_TIMEZONE, 'last_key': last_key, 'batch_size': 5000})
+            keys = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+
+        if not keys:
+            break
+        last_key = max(keys)
+
+    # Подмена колонки: короткая транзакция, заодно догоняем строки, вставленные во время бэкфилла
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(LEGACY_TIMESTAMPTZ_FUNCTION)
+        cursor.execute(
+            f'UPDATE {table} SET {new_column} = {converted} WHERE {new_column} IS NULL AND {column} IS NOT NULL',
+            {'tz': BOT_TIMEZONE}
+        )
+        cursor.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+        cursor.execute(f'ALTER TABLE {table} RENAME COLUMN {new_column} TO {column}')
+        cursor.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT NOW()')
+        conn.commit()
+
+    print(f"✅ {table}.{column} переведена в TIMESTAMPTZ")
+
+# Версии схемы: (версия, описание, шаги). Шаг — SQL-строка (выполняется в своей транзакции)
+# или функция. Шаги идемпотентны: прерванная миграция просто повторяется при следующем запуске.
+SCHEMA_MIGRATIONS = [
+    (1, 'Таблицы users и reputation', [
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username TEXT,
                 registered_at TEXT
             )
-        ''')
-        
-        cursor.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS reputation (
                 id SERIAL PRIMARY KEY,
                 from_user BIGINT,
@@ -118,277 +417,504 @@ def init_db():
                 photo_id TEXT,
                 created_at TEXT
             )
+        ''',
+    ]),
+    (2, 'Полярность отзывов', [
+        'ALTER TABLE reputation ADD COLUMN IF NOT EXISTS polarity CHAR(1)',
+        lambda: backfill_reputation_polarity(),
+    ]),
+    (3, 'Счётчики репутации', [
+        '''
+            CREATE TABLE IF NOT EXISTS reputation_counters (
+                user_id BIGINT PRIMARY KEY,
+                positive INTEGER NOT NULL DEFAULT 0,
+                negative INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        # Счётчики заполняет миграция 8: rebuild_reputation_counters() пишет и её колонки
+    ]),
+    # Индексы по created_at строит миграция 6, уже по колонке TIMESTAMPTZ
+    (4, 'Индексы отзывов и пользователей', [
+        concurrent_index('idx_users_username_lower', 'ON users (lower(username))'),
+    ]),
+    (5, 'Даты в TIMESTAMPTZ', [
+        lambda: migrate_to_timestamptz('reputation', 'created_at', 'id'),
+        lambda: migrate_to_timestamptz('users', 'registered_at', 'user_id'),
+    ]),
+    (6, 'Индексы по датам отзывов', [
+        concurrent_index('idx_reputation_to_user_created', 'ON reputation (to_user, created_at DESC, id DESC)'),
+        concurrent_index('idx_reputation_from_user_created', 'ON reputation (from_user, created_at DESC, id DESC)'),
+        concurrent_index('idx_reputation_to_user_polarity_created', 'ON reputation (to_user, polarity, created_at DESC, id DESC)'),
+        concurrent_index('idx_reputation_created_at', 'ON reputation (created_at)'),
+    ]),
+    # Курсоры страниц (created_at, id) не работают с NULL — нераспознанные старые даты ставим в начало эпохи
+    (7, 'Отзывы без даты', [
+        "UPDATE reputation SET created_at = to_timestamp(0) WHERE created_at IS NULL",
+    ]),
+    (8, 'Последние отзывы в счётчиках', [
+        '''
+            ALTER TABLE reputation_counters
+                ADD COLUMN IF NOT EXISTS last_positive_id INTEGER,
+                ADD COLUMN IF NOT EXISTS last_negative_id INTEGER
+        ''',
+        lambda: rebuild_reputation_counters(),
+    ]),
+    (9, 'Снимки топов по периодам', [
+        '''
+            CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
+                period TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                total INTEGER NOT NULL,
+                positive INTEGER NOT NULL,
+                negative INTEGER NOT NULL,
+                refreshed_at TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (period, rank)
+            )
+        ''',
+    ]),
+    (10, 'Дневные счётчики отзывов', [
+        '''
+            CREATE TABLE IF NOT EXISTS reputation_daily (
+                user_id BIGINT NOT NULL,
+                day DATE NOT NULL,
+                positive INTEGER NOT NULL DEFAULT 0,
+                negative INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''',
+        concurrent_index('idx_reputation_daily_day', 'ON reputation_daily (day)'),
+        # Счётчики заполняет init_db после всех миграций: пояса в bot_settings ещё нет
+    ]),
+    (11, 'Рассылки с прогрессом по получателям', [
+        '''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                text TEXT NOT NULL,
+                admin_id BIGINT,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            )
+        ''',
+        # status: p — ждёт отправки, s — отправлено, f — ошибка
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                status CHAR(1) NOT NULL DEFAULT 'p',
+                error TEXT,
+                PRIMARY KEY (broadcast_id, user_id)
+            )
+        ''',
+        concurrent_index('idx_broadcast_recipients_pending',
+                         "ON broadcast_recipients (broadcast_id, user_id) WHERE status = 'p'"),
+    ]),
+    (12, 'Недоступные для рассылки пользователи', [
+        '''
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS unreachable_reason TEXT,
+                ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMPTZ
+        ''',
+        concurrent_index('idx_users_reachable', 'ON users (user_id) WHERE unreachable_reason IS NULL'),
+    ]),
+    (13, 'Изменения для инкрементальных бэкапов', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ',
+        '''
+            CREATE TABLE IF NOT EXISTS reputation_deletions (
+                rep_id INTEGER PRIMARY KEY,
+                deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''',
+        concurrent_index('idx_users_updated_at', 'ON users (updated_at)'),
+        concurrent_index('idx_reputation_deletions_deleted_at', 'ON reputation_deletions (deleted_at)'),
+    ]),
+]
+
+def apply_schema_migrations():
+    """Применить недостающие версии схемы"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
         ''')
-        
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cursor.fetchall()}
         conn.commit()
-        print("✅ Таблицы созданы/проверены")
+
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+
+        print(f"🔧 Миграция схемы {version}: {description}")
+        for step in steps:
+            if callable(step):
+                step()
+            else:
+                with db_connection() as conn:
+                    conn.cursor().execute(step)
+                    conn.commit()
+
+        with db_connection() as conn:
+            conn.cursor().execute(
+                'INSERT INTO schema_migrations (version, description) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+                (version, description)
+            )
+            conn.commit()
+
+    return max((version for version, _, _ in SCHEMA_MIGRATIONS), default=0)
+
+def init_db():
+    """Инициализация базы данных"""
+    try:
+        version = apply_schema_migrations()
+        print(f"✅ Таблицы созданы/проверены (версия схемы {version})")
+
+        # Дневные счётчики посчитаны в другом часовом поясе — пересобираем
+        if get_setting('reputation_daily_timezone') != BOT_TIMEZONE:
+            rebuild_reputation_daily()
+        return True
     except Exception as e:
         print(f"❌ Ошибка создания таблиц: {e}")
-    finally:
-        conn.close()
+        return False
 
 def check_database_connection():
     """Проверка подключения к БД"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM users')
-        users_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM reputation')
-        reps_count = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT COUNT(*) FROM users')
+            users_count = cursor.fetchone()[0]
+
+            cursor.execute('SELECT COUNT(*) FROM reputation')
+            reps_count = cursor.fetchone()[0]
+
         print(f"✅ Подключение к БД: Успешно")
         print(f"👥 Пользователей в БД: {users_count}")
         print(f"📝 Отзывов в БД: {reps_count}")
-        
+
         return True
     except Exception as e:
         print(f"❌ Ошибка подключения к БД: {e}")
         return False
 
 # ========== ФУНКЦИИ БАЗЫ ДАННЫХ ==========
+def upsert_user(cursor, user_id, username):
+    """INSERT ... ON CONFLICT пользователя на переданном курсоре; True, если строка изменилась
+
+    username=None — username неизвестен (цель указана по ID): сохранённый username не трогается.
+    """
+    cursor.execute('''
+        INSERT INTO users (user_id, username, registered_at, updated_at)
+        VALUES (%s, %s, NOW(), NOW())
+        ON CONFLICT (user_id) DO UPDATE
+        SET username = EXCLUDED.username, updated_at = NOW()
+        WHERE EXCLUDED.username IS NOT NULL AND users.username IS DISTINCT FROM EXCLUDED.username
+    ''', (user_id, username))
+    return cursor.rowcount > 0
+
 def save_user(user_id, username):
     """Сохраняем пользователя в БД"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            INSERT INTO users (user_id, username, registered_at) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE 
-            SET username = EXCLUDED.username
-        ''', (user_id, username, datetime.now().isoformat()))
-        
-        conn.commit()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            changed = upsert_user(cursor, user_id, username)
+
+            conn.commit()
+
+        user_write_buffer.forget(user_id)
+        # Пустой апдейт (username не изменился) не трогает строку и не сбрасывает кэш
+        if changed:
+            profile_cache.invalidate(user_id)
     except Exception as e:
         print(f"❌ Ошибка сохранения пользователя {user_id}: {e}")
-    finally:
-        conn.close()
 
-def save_reputation(from_user, from_username, to_user, to_username, text, photo_id):
-    """Сохраняем репутацию в БД"""
-    save_user(from_user, from_username)
-    save_user(to_user, to_username)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def save_reputation(from_user, from_username, to_user, to_username, text, photo_id, polarity=None):
+    """Сохраняем репутацию в БД: оба пользователя, отзыв и счётчики — одной транзакцией
     
+    polarity — уже разобранный знак команды; без него определяется по тексту.
+    """
     try:
-        cursor.execute('''
-            INSERT INTO reputation (from_user, to_user, text, photo_id, created_at)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (from_user, to_user, text, photo_id, datetime.now().isoformat()))
-        
-        conn.commit()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            # Строки пользователей блокируются по возрастанию user_id, чтобы встречные отзывы
+            # A→B и B→A не ждали друг друга. Отправителя скрытой пересылки (None) в базе нет
+            users = {user_id: username for user_id, username in ((from_user, from_username), (to_user, to_username))
+                     if user_id is not None}
+            changed = {user_id: upsert_user(cursor, user_id, users[user_id]) for user_id in sorted(users)}
+            from_changed = changed.get(from_user, False)
+
+            if polarity is None:
+                polarity = get_reputation_polarity(text)
+            cursor.execute('''
+                INSERT INTO reputation (from_user, to_user, text, photo_id, created_at, polarity)
+                VALUES (%s, %s, %s, %s, NOW(), %s)
+                RETURNING id, created_at
+            ''', (from_user, to_user, text, photo_id, polarity))
+            rep_id, created_at = cursor.fetchone()
+
+            # Счётчики обновляются в той же транзакции, что и сам отзыв
+            update_reputation_counters(cursor, to_user, polarity, 1, rep_id)
+            update_reputation_daily(cursor, to_user, created_at, polarity, 1)
+
+            conn.commit()
+
+        # Строки пользователей записаны в обход буфера — пусть следующее сообщение сверит username заново
+        user_write_buffer.forget(*users)
+        # Профиль получателя меняется всегда, отправителя — только при смене username
+        if from_changed:
+            profile_cache.invalidate(from_user, to_user)
+        else:
+            profile_cache.invalidate(to_user)
         print(f"✅ Репутация сохранена: {from_user} → {to_user}")
+        return True
     except Exception as e:
         print(f"❌ Ошибка сохранения репутации: {e}")
-    finally:
-        conn.close()
+        return False
 
-def get_all_users():
-    """Получить всех пользователей из БД"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    users = []
+def count_users(reachable_only=False):
+    """Количество пользователей в БД (reachable_only — без недоступных для рассылки)"""
     try:
-        cursor.execute('SELECT user_id FROM users')
-        rows = cursor.fetchall()
-        users = [{'user_id': row[0]} for row in rows]
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if reachable_only:
+                cursor.execute('SELECT COUNT(*) FROM users WHERE unreachable_reason IS NULL')
+            else:
+                cursor.execute('SELECT COUNT(*) FROM users')
+            return cursor.fetchone()[0]
     except Exception as e:
-        print(f"❌ Ошибка получения пользователей: {e}")
-    finally:
-        conn.close()
-    
-    return users
+        print(f"❌ Ошибка подсчёта пользователей: {e}")
+        return 0
 
-def get_user_reputation(user_id):
-    """Получаем всю репутацию пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    reps = []
+def mark_user_reachable(user_id):
+    """Снять отметку недоступности (пользователь снова написал боту)"""
     try:
-        cursor.execute('''
-            SELECT r.*, u.username as from_username 
-            FROM reputation r
-            LEFT JOIN users u ON r.from_user = u.user_id
-            WHERE r.to_user = %s
-            ORDER BY r.created_at DESC
-        ''', (user_id,))
-        
-        rows = cursor.fetchall()
-        
-        for row in rows:
-            from_username = row[6]
-            if not from_username and row[1] is None:
-                from_username = "Скрытый профиль"
-            elif not from_username:
-                from_username = f"id{row[1]}"
-            
-            reps.append({
-                'id': row[0],
-                'from_user': row[1],
-                'to_user': row[2],
-                'text': row[3],
-                'photo_id': row[4],
-                'created_at': row[5],
-                'from_username': from_username
-            })
+        with db_connection() as conn:
+            conn.cursor().execute('''
+                UPDATE users SET unreachable_reason = NULL, unreachable_at = NULL, updated_at = NOW()
+                WHERE user_id = %s AND unreachable_reason IS NOT NULL
+            ''', (user_id,))
+            conn.commit()
     except Exception as e:
-        print(f"❌ Ошибка получения репутации: {e}")
-    finally:
-        conn.close()
-    
-    return reps
+        print(f"❌ Ошибка отметки пользователя {user_id}: {e}")
+
+# Отзывов на одной странице списка
+REPUTATION_PAGE_SIZE = 10
+
+# Колонки отзыва в порядке, который ожидает reputation_from_row
+REPUTATION_COLUMNS = 'r.id, r.from_user, r.to_user, r.text, r.photo_id, r.created_at, r.polarity'
+
+def reputation_from_row(row):
+    """Отзыв из строки SELECT REPUTATION_COLUMNS, from_username[, to_username]"""
+    from_username = row[7]
+    if not from_username and row[1] is None:
+        from_username = "Скрытый профиль"
+    elif not from_username:
+        from_username = f"id{row[1]}"
+
+    rep = {
+        'id': row[0],
+        'from_user': row[1],
+        'to_user': row[2],
+        'text': row[3],
+        'photo_id': row[4],
+        'created_at': row[5],
+        'polarity': row[6],
+        'from_username': from_username
+    }
+
+    if len(row) > 8:
+        rep['to_username'] = row[8] or f"id{row[2]}"
+
+    return rep
+
+def get_user_reputation_page(user_id, polarity=None, after=None, before=None, limit=REPUTATION_PAGE_SIZE):
+    """Страница отзывов по ключу (created_at, id): after — следующая страница, before — предыдущая"""
+    conditions = ['r.to_user = %s']
+    params = [user_id]
+
+    if polarity:
+        conditions.append('r.polarity = %s')
+        params.append(polarity)
+
+    if after:
+        conditions.append('(r.created_at, r.id) < (%s, %s)')
+        params.extend(after)
+    elif before:
+        conditions.append('(r.created_at, r.id) > (%s, %s)')
+        params.extend(before)
+
+    # Назад листаем в обратном порядке по тому же индексу, потом разворачиваем страницу
+    order = 'ASC' if before else 'DESC'
+    counter_column = {'+': 'positive', '-': 'negative'}.get(polarity, 'total')
+
+    page = {'reps': [], 'has_prev': False, 'has_next': False, 'total': 0}
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {REPUTATION_COLUMNS}, u.username as from_username
+                FROM reputation r
+                LEFT JOIN users u ON r.from_user = u.user_id
+                WHERE {' AND '.join(conditions)}
+                ORDER BY r.created_at {order}, r.id {order}
+                LIMIT %s
+            ''', (*params, limit + 1))
+            rows = cursor.fetchall()
+
+            cursor.execute(
+                f'SELECT {counter_column} FROM reputation_counters WHERE user_id = %s',
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            page['total'] = row[0] if row else 0
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if before:
+            rows.reverse()
+            page['has_prev'] = has_more
+            page['has_next'] = True
+        else:
+            page['has_prev'] = after is not None
+            page['has_next'] = has_more
+
+        page['reps'] = [reputation_from_row(row) for row in rows]
+    except Exception as e:
+        print(f"❌ Ошибка получения страницы отзывов {user_id}: {e}")
+
+    return page
 
 def get_reputation_by_id(rep_id):
     """Получить отзыв по ID"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            SELECT r.*, u.username as from_username 
-            FROM reputation r
-            LEFT JOIN users u ON r.from_user = u.user_id
-            WHERE r.id = %s
-        ''', (rep_id,))
-        
-        row = cursor.fetchone()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {REPUTATION_COLUMNS}, u.username as from_username
+                FROM reputation r
+                LEFT JOIN users u ON r.from_user = u.user_id
+                WHERE r.id = %s
+            ''', (rep_id,))
+
+            row = cursor.fetchone()
+
         if row:
-            from_username = row[6]
-            if not from_username and row[1] is None:
-                from_username = "Скрытый профиль"
-            elif not from_username:
-                from_username = f"id{row[1]}"
-            
-            return {
-                'id': row[0],
-                'from_user': row[1],
-                'to_user': row[2],
-                'text': row[3],
-                'photo_id': row[4],
-                'created_at': row[5],
-                'from_username': from_username
-            }
+            return reputation_from_row(row)
     except Exception as e:
         print(f"❌ Ошибка получения отзыва {rep_id}: {e}")
-    finally:
-        conn.close()
-    
+
     return None
 
 def delete_reputation_by_id(rep_id):
     """Удалить отзыв по ID"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('DELETE FROM reputation WHERE id = %s', (rep_id,))
-        conn.commit()
-        deleted = cursor.rowcount > 0
-        return deleted
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM reputation WHERE id = %s RETURNING to_user, polarity, created_at', (rep_id,))
+            row = cursor.fetchone()
+            if row:
+                update_reputation_counters(cursor, row[0], row[1], -1, rep_id)
+                update_reputation_daily(cursor, row[0], row[2], row[1], -1)
+                # Удаление попадёт в следующий инкрементальный бэкап
+                cursor.execute(
+                    'INSERT INTO reputation_deletions (rep_id) VALUES (%s) ON CONFLICT DO NOTHING',
+                    (rep_id,)
+                )
+            conn.commit()
+            if row:
+                profile_cache.invalidate(row[0])
+            deleted = row is not None
+            return deleted
     except Exception as e:
         print(f"❌ Ошибка удаления отзыва {rep_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_reputations_by_user_id(user_id):
     """Получить все отзывы пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     reps = []
     try:
-        cursor.execute('''
-            SELECT r.*, u1.username as from_username, u2.username as to_username
-            FROM reputation r
-            LEFT JOIN users u1 ON r.from_user = u1.user_id
-            LEFT JOIN users u2 ON r.to_user = u2.user_id
-            WHERE r.from_user = %s OR r.to_user = %s
-            ORDER BY r.created_at DESC
-            LIMIT 100
-        ''', (user_id, user_id))
-        
-        rows = cursor.fetchall()
-        
-        for row in rows:
-            from_username = row[6]
-            if not from_username and row[1] is None:
-                from_username = "Скрытый профиль"
-            elif not from_username:
-                from_username = f"id{row[1]}"
-            
-            to_username = row[7]
-            if not to_username:
-                to_username = f"id{row[2]}"
-            
-            reps.append({
-                'id': row[0],
-                'from_user': row[1],
-                'to_user': row[2],
-                'text': row[3],
-                'photo_id': row[4],
-                'created_at': row[5],
-                'from_username': from_username,
-                'to_username': to_username
-            })
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {REPUTATION_COLUMNS}, u1.username as from_username, u2.username as to_username
+                FROM (
+                    -- Каждая ветка идёт по своему индексу (from_user/to_user, created_at DESC) вместо OR-скана
+                    (SELECT * FROM reputation WHERE from_user = %s ORDER BY created_at DESC, id DESC LIMIT 100)
+                    UNION
+                    (SELECT * FROM reputation WHERE to_user = %s ORDER BY created_at DESC, id DESC LIMIT 100)
+                ) r
+                LEFT JOIN users u1 ON r.from_user = u1.user_id
+                LEFT JOIN users u2 ON r.to_user = u2.user_id
+                ORDER BY r.created_at DESC, r.id DESC
+                LIMIT 100
+            ''', (user_id, user_id))
+
+            rows = cursor.fetchall()
+
+        reps = [reputation_from_row(row) for row in rows]
     except Exception as e:
         print(f"❌ Ошибка получения отзывов пользователя {user_id}: {e}")
-    finally:
-        conn.close()
-    
+
     return reps
 
 def get_db_stats():
     """Статистика базы данных"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     stats = {}
     try:
-        cursor.execute('SELECT COUNT(*) FROM users')
-        stats['total_users'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM reputation')
-        stats['total_reputations'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM reputation WHERE text LIKE '%%+%%' OR text LIKE '%%+rep%%' OR text LIKE '%%+реп%%'")
-        stats['positive_reps'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM reputation WHERE text LIKE '%%-%%' OR text LIKE '%%-rep%%' OR text LIKE '%%-реп%%'")
-        stats['negative_reps'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(DISTINCT from_user) FROM reputation')
-        stats['unique_senders'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(DISTINCT to_user) FROM reputation')
-        stats['unique_receivers'] = cursor.fetchone()[0]
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT COUNT(*) FROM users')
+            stats['total_users'] = cursor.fetchone()[0]
+
+            # Один проход по отзывам вместо отдельного LIKE-скана на каждый счётчик
+            cursor.execute('''
+                SELECT COUNT(*),
+                       COUNT(*) FILTER (WHERE polarity = '+'),
+                       COUNT(*) FILTER (WHERE polarity = '-'),
+                       COUNT(DISTINCT from_user),
+                       COUNT(DISTINCT to_user)
+                FROM reputation
+            ''')
+            row = cursor.fetchone()
+            stats['total_reputations'] = row[0]
+            stats['positive_reps'] = row[1]
+            stats['negative_reps'] = row[2]
+            stats['unique_senders'] = row[3]
+            stats['unique_receivers'] = row[4]
+
     except Exception as e:
         print(f"❌ Ошибка получения статистики: {e}")
-    finally:
-        conn.close()
-    
+
     return stats
 
 def get_user_info(user_id):
     """Получаем информацию о пользователе"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-        row = cursor.fetchone()
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
+            row = cursor.fetchone()
+
         if row:
             return {
                 'user_id': row[0],
@@ -397,24 +923,21 @@ def get_user_info(user_id):
             }
     except Exception as e:
         print(f"❌ Ошибка получения пользователя {user_id}: {e}")
-    finally:
-        conn.close()
-    
+
     return None
 
 def get_user_by_username(username):
     """Ищем пользователя по username (без учета регистра)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     username = username.lstrip('@')
     print(f"🔄 Поиск в БД: username='{username}'")
-    
+
     try:
-        # Используем ILIKE для поиска без учета регистра
-        cursor.execute('SELECT * FROM users WHERE username ILIKE %s', (username,))
-        row = cursor.fetchone()
-        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            # Поиск без учета регистра по функциональному индексу lower(username)
+            cursor.execute('SELECT * FROM users WHERE lower(username) = lower(%s)', (username,))
+            row = cursor.fetchone()
+
         if row:
             print(f"✅ Найден в БД: ID={row[0]}, username='{row[1]}'")
             return {
@@ -428,123 +951,479 @@ def get_user_by_username(username):
     except Exception as e:
         print(f"❌ Ошибка поиска пользователя {username}: {e}")
         return None
-    finally:
-        conn.close()
 
-def get_reputation_stats(user_id):
-    """Статистика репутации пользователя"""
-    all_reps = get_user_reputation(user_id)
-    
-    positive = 0
-    negative = 0
-    
-    for rep in all_reps:
-        rep_type = get_reputation_type(rep["text"])
-        if rep_type == '+':
-            positive += 1
-        elif rep_type == '-':
-            negative += 1
-    
-    total = positive + negative
-    positive_percent = (positive / total * 100) if total > 0 else 0
-    negative_percent = (negative / total * 100) if total > 0 else 0
-    
-    return {
-        'total': total,
-        'positive': positive,
-        'negative': negative,
-        'positive_percent': positive_percent,
-        'negative_percent': negative_percent,
-        'all_reps': all_reps
+# ========== СЧЁТЧИКИ РЕПУТАЦИИ ==========
+# Колонка «последнего отзыва» в reputation_counters для каждой полярности
+LAST_REPUTATION_COLUMNS = {'+': 'last_positive_id', '-': 'last_negative_id'}
+
+def find_last_reputation_id(cursor, user_id, polarity):
+    """ID последнего отзыва пользователя с данной полярностью (одна строка по индексу)"""
+    cursor.execute('''
+        SELECT id FROM reputation
+        WHERE to_user = %s AND polarity = %s
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1
+    ''', (user_id, polarity))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def update_reputation_counters(cursor, user_id, rep_type, delta, rep_id):
+    """Изменить счётчики пользователя на delta (вызывается внутри транзакции отзыва)"""
+    positive = delta if rep_type == '+' else 0
+    negative = delta if rep_type == '-' else 0
+    # Новый отзыв сразу становится последним своей полярности
+    last_positive_id = rep_id if rep_type == '+' and delta > 0 else None
+    last_negative_id = rep_id if rep_type == '-' and delta > 0 else None
+
+    cursor.execute('''
+        INSERT INTO reputation_counters (user_id, positive, negative, total, last_positive_id, last_negative_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE
+        SET positive = reputation_counters.positive + EXCLUDED.positive,
+            negative = reputation_counters.negative + EXCLUDED.negative,
+            total = reputation_counters.total + EXCLUDED.total,
+            last_positive_id = COALESCE(EXCLUDED.last_positive_id, reputation_counters.last_positive_id),
+            last_negative_id = COALESCE(EXCLUDED.last_negative_id, reputation_counters.last_negative_id)
+        RETURNING last_positive_id, last_negative_id
+    ''', (user_id, positive, negative, delta, last_positive_id, last_negative_id))
+
+    # Удалён последний отзыв — ищем предыдущий одним запросом по индексу
+    column = LAST_REPUTATION_COLUMNS.get(rep_type)
+    if delta < 0 and column and rep_id in cursor.fetchone():
+        cursor.execute(
+            f'UPDATE reputation_counters SET {column} = %s WHERE user_id = %s',
+            (find_last_reputation_id(cursor, user_id, rep_type), user_id)
+        )
+
+def rebuild_reputation_counters():
+    """Пересчитать счётчики репутации по всем отзывам"""
+    # Старые строки (например, из восстановленного бэкапа) могут быть ещё без полярности
+    backfill_reputation_polarity()
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Блокируем счётчики до пересчёта: новые отзывы подождут и не потеряются при замене
+        cursor.execute('LOCK TABLE reputation_counters IN EXCLUSIVE MODE')
+        cursor.execute('DELETE FROM reputation_counters')
+        cursor.execute('''
+            INSERT INTO reputation_counters (user_id, positive, negative, total, last_positive_id, last_negative_id)
+            SELECT to_user,
+                   COUNT(*) FILTER (WHERE polarity = '+'),
+                   COUNT(*) FILTER (WHERE polarity = '-'),
+                   COUNT(*),
+                   (array_agg(id ORDER BY created_at DESC, id DESC) FILTER (WHERE polarity = '+'))[1],
+                   (array_agg(id ORDER BY created_at DESC, id DESC) FILTER (WHERE polarity = '-'))[1]
+            FROM reputation
+            GROUP BY to_user
+        ''')
+        users_count = cursor.rowcount
+        conn.commit()
+
+    profile_cache.clear()
+    print(f"✅ Счётчики репутации пересчитаны: {users_count} пользователей")
+    return users_count
+
+def get_setting(key):
+    """Значение из bot_settings или None"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM bot_settings WHERE key = %s', (key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_setting(cursor, key, value):
+    """Записать значение в bot_settings (внутри транзакции вызывающего)"""
+    cursor.execute('''
+        INSERT INTO bot_settings (key, value) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    ''', (key, value))
+
+def update_reputation_daily(cursor, user_id, created_at, rep_type, delta):
+    """Изменить дневной счётчик пользователя за день отзыва (в BOT_TIMEZONE)"""
+    positive = delta if rep_type == '+' else 0
+    negative = delta if rep_type == '-' else 0
+
+    cursor.execute('''
+        INSERT INTO reputation_daily (user_id, day, positive, negative, total)
+        VALUES (%(user_id)s, (%(created_at)s::timestamptz AT TIME ZONE %(tz)s)::date,
+                %(positive)s, %(negative)s, %(delta)s)
+        ON CONFLICT (user_id, day) DO UPDATE
+        SET positive = reputation_daily.positive + EXCLUDED.positive,
+            negative = reputation_daily.negative + EXCLUDED.negative,
+            total = reputation_daily.total + EXCLUDED.total
+        RETURNING total
+    ''', {'user_id': user_id, 'created_at': created_at, 'tz': BOT_TIMEZONE,
+          'positive': positive, 'negative': negative, 'delta': delta})
+
+    # Опустевший день не хранится
+    if cursor.fetchone()[0] <= 0:
+        cursor.execute('''
+            DELETE FROM reputation_daily
+            WHERE user_id = %(user_id)s AND day = (%(created_at)s::timestamptz AT TIME ZONE %(tz)s)::date
+        ''', {'user_id': user_id, 'created_at': created_at, 'tz': BOT_TIMEZONE})
+
+def rebuild_reputation_daily():
+    """Пересчитать дневные счётчики по всем отзывам в часовом поясе BOT_TIMEZONE"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('LOCK TABLE reputation_daily IN EXCLUSIVE MODE')
+        cursor.execute('DELETE FROM reputation_daily')
+        cursor.execute('''
+            INSERT INTO reputation_daily (user_id, day, positive, negative, total)
+            SELECT to_user,
+                   (created_at AT TIME ZONE %s)::date,
+                   COUNT(*) FILTER (WHERE polarity = '+'),
+                   COUNT(*) FILTER (WHERE polarity = '-'),
+                   COUNT(*)
+            FROM reputation
+            GROUP BY 1, 2
+        ''', (BOT_TIMEZONE,))
+        days_count = cursor.rowcount
+        set_setting(cursor, 'reputation_daily_timezone', BOT_TIMEZONE)
+        conn.commit()
+
+    print(f"✅ Дневные счётчики пересчитаны ({BOT_TIMEZONE}): {days_count} записей")
+    return days_count
+
+def backfill_reputation_polarity(batch_size=1000):
+    """Заполнить полярность у старых отзывов пачками по batch_size строк"""
+    last_id = 0
+    updated = 0
+
+    while True:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, text FROM reputation
+                WHERE polarity IS NULL AND id > %s
+                ORDER BY id
+                LIMIT %s
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+
+            if not rows:
+                break
+
+            psycopg2.extras.execute_values(
+                cursor,
+                '''
+                    UPDATE reputation AS r SET polarity = v.polarity
+                    FROM (VALUES %s) AS v (id, polarity)
+                    WHERE r.id = v.id
+                ''',
+                [(rep_id, get_reputation_polarity(text)) for rep_id, text in rows],
+                page_size=batch_size
+            )
+            # Каждая пачка — отдельная короткая транзакция, прерванный бэкфилл продолжится с того же места
+            conn.commit()
+
+        last_id = rows[-1][0]
+        updated += len(rows)
+
+    if updated:
+        print(f"✅ Полярность заполнена у {updated} отзывов")
+    return updated
+
+def get_reputation_stats(user_id):
+    """Статистика репутации пользователя (из таблицы счётчиков)"""
+    positive = 0
+    negative = 0
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT positive, negative FROM reputation_counters WHERE user_id = %s',
+                (user_id,)
+            )
+            row = cursor.fetchone()
+
+        if row:
+            positive, negative = row
+    except Exception as e:
+        print(f"❌ Ошибка получения счётчиков репутации {user_id}: {e}")
+
+    total = positive + negative
+    positive_percent = (positive / total * 100) if total > 0 else 0
+    negative_percent = (negative / total * 100) if total > 0 else 0
+
+    return {
+        'total': total,
+        'positive': positive,
+        'negative': negative,
+        'positive_percent': positive_percent,
+        'negative_percent': negative_percent
     }
 
+def get_last_reputation(user_id, polarity):
+    """Последний отзыв с данной полярностью: ID берётся из счётчиков, отзыв — по первичному ключу"""
+    column = LAST_REPUTATION_COLUMNS[polarity]
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {REPUTATION_COLUMNS}, u.username as from_username
+                FROM reputation_counters c
+                JOIN reputation r ON r.id = c.{column}
+                LEFT JOIN users u ON r.from_user = u.user_id
+                WHERE c.user_id = %s
+            ''', (user_id,))
+            row = cursor.fetchone()
+
+        if row:
+            return reputation_from_row(row)
+    except Exception as e:
+        print(f"❌ Ошибка получения последнего отзыва {user_id}: {e}")
+
+    return None
+
 def get_last_positive(user_id):
     """Получить последний положительный отзыв"""
-    all_reps = get_user_reputation(user_id)
-    for rep in all_reps:
-        if get_reputation_type(rep["text"]) == '+':
-            return rep
-    return None
+    return get_last_reputation(user_id, '+')
 
 def get_last_negative(user_id):
     """Получить последний отрицательный отзыв"""
-    all_reps = get_user_reputation(user_id)
-    for rep in all_reps:
-        if get_reputation_type(rep["text"]) == '-':
-            return rep
-    return None
+    return get_last_reputation(user_id, '-')
+
+# ========== КЭШ ПРОФИЛЕЙ ==========
+class ProfileCache:
+    """LRU-кэш данных профиля (пользователь + статистика) с временем жизни записей"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        # Меняется при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._version = 0
+
+    def get_or_load(self, key, loader):
+        """Значение из кэша или loader() с сохранением результата"""
+        with self._lock:
+            item = self._items.get(key)
+            if item and time.monotonic() - item[0] < self.ttl:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            version = self._version
+
+        value = loader()
+
+        with self._lock:
+            if version == self._version:
+                self._items[key] = (time.monotonic(), value)
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+
+        return value
+
+    def invalidate(self, *keys):
+        """Удалить записи (после изменения данных пользователя)"""
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        """Очистить кэш целиком (после восстановления или пересчёта)"""
+        with self._lock:
+            self._version += 1
+            self._items.clear()
+
+    def stats(self):
+        """Счётчики попаданий для админ-статистики"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total * 100) if total > 0 else 0
+            }
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+def get_profile_data(user_id):
+    """Данные для карточки профиля: пользователь и статистика репутации (через кэш)"""
+    return profile_cache.get_or_load(user_id, lambda: {
+        'user_info': get_user_info(user_id),
+        'stats': get_reputation_stats(user_id)
+    })
+
+# ========== ОТЛОЖЕННАЯ ЗАПИСЬ ПОЛЬЗОВАТЕЛЕЙ ==========
+class UserWriteBuffer:
+    """Пакетная запись пользователей из потока сообщений: без изменений — без запросов к БД"""
+
+    def __init__(self, flush_interval, known_limit):
+        self.flush_interval = flush_interval
+        self.known_limit = known_limit
+        self.skipped = 0
+        self.written = 0
+        # user_id -> username, который уже точно лежит в БД
+        self._known = OrderedDict()
+        # user_id -> username, ждущие следующей пакетной записи
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def note(self, user_id, username):
+        """Запомнить пользователя из сообщения (запись в БД — только если он новый или сменил username)"""
+        with self._lock:
+            if user_id not in self._pending and self._known.get(user_id) == username:
+                self._known.move_to_end(user_id)
+                self.skipped += 1
+                return
+            self._pending[user_id] = username
+
+    def flush(self):
+        """Записать накопленных пользователей одним INSERT ... ON CONFLICT (выполняется в потоке БД)"""
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+
+        if not batch:
+            return 0
+
+        try:
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                changed = psycopg2.extras.execute_values(
+                    cursor,
+                    '''
+                        INSERT INTO users (user_id, username, registered_at, updated_at) VALUES %s
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET username = EXCLUDED.username, updated_at = NOW()
+                        WHERE users.username IS DISTINCT FROM EXCLUDED.username
+                        RETURNING user_id
+                    ''',
+                    # Блокировки строк по возрастанию user_id, как в save_reputation
+                    sorted(batch.items()),
+                    template='(%s, %s, NOW(), NOW())',
+                    page_size=1000,
+                    fetch=True
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка пакетной записи пользователей: {e}")
+            # Вернём пачку в очередь, если за это время не пришли более свежие данные
+            with self._lock:
+                for user_id, username in batch.items():
+                    self._pending.setdefault(user_id, username)
+            return 0
+
+        with self._lock:
+            for user_id, username in batch.items():
+                self._known[user_id] = username
+                self._known.move_to_end(user_id)
+            while len(self._known) > self.known_limit:
+                self._known.popitem(last=False)
+            self.written += len(batch)
+
+        if changed:
+            profile_cache.invalidate(*(row[0] for row in changed))
+
+        return len(batch)
+
+    def forget(self, *user_ids):
+        """Забыть пользователей, записанных в БД в обход буфера"""
+        with self._lock:
+            for user_id in user_ids:
+                self._known.pop(user_id, None)
+
+    def forget_known(self):
+        """Забыть записанных пользователей (после восстановления БД их строк может не быть)"""
+        with self._lock:
+            self._known.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await run_db(self.flush)
+            except Exception as e:
+                print(f"❌ Ошибка фоновой записи пользователей: {e}")
+
+    def start(self):
+        """Запустить периодическую запись (из post_init приложения)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановить периодическую запись и дописать остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await run_db(self.flush)
+
+user_write_buffer = UserWriteBuffer(USER_FLUSH_INTERVAL, KNOWN_USERS_LIMIT)
 
 # ========== ФУНКЦИИ ДЛЯ ТОПОВ ==========
+def query_top_users(cursor, days=None, limit=10):
+    """Топ по отзывам за последние days календарных дней (в BOT_TIMEZONE) или за всё время"""
+    if days:
+        # Не больше days дневных записей на пользователя вместо скана отзывов
+        cursor.execute("""
+            SELECT d.user_id, u.username,
+                   SUM(d.total)::int as rep_count,
+                   SUM(d.positive)::int as positive_count,
+                   SUM(d.negative)::int as negative_count
+            FROM reputation_daily d
+            LEFT JOIN users u ON u.user_id = d.user_id
+            WHERE d.day > (NOW() AT TIME ZONE %(tz)s)::date - %(days)s
+            GROUP BY d.user_id, u.username
+            ORDER BY rep_count DESC, d.user_id
+            LIMIT %(limit)s
+        """, {'tz': BOT_TIMEZONE, 'days': days, 'limit': limit})
+    else:
+        # За всё время — готовые счётчики
+        cursor.execute("""
+            SELECT c.user_id, u.username, c.total, c.positive, c.negative
+            FROM reputation_counters c
+            LEFT JOIN users u ON u.user_id = c.user_id
+            WHERE c.total > 0
+            ORDER BY c.total DESC, c.user_id
+            LIMIT %(limit)s
+        """, {'limit': limit})
+    
+    return [top_entry(i, row[0], row[1], row[2], row[3], row[4])
+            for i, row in enumerate(cursor.fetchall(), 1)]
+
+def top_entry(rank, user_id, username, total, positive, negative):
+    """Строка топа в виде словаря для format_top_message"""
+    return {
+        'rank': rank,
+        'user_id': user_id,
+        'username': username or f"id{user_id}",
+        'total_reps': total,
+        'positive': positive,
+        'negative': negative,
+        'percentage': (positive / total * 100) if total > 0 else 0
+    }
+
 def get_top_users_by_period(days=None, limit=10):
     """Получить топ пользователей по количеству отзывов за период"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        if days:
-            # За указанное количество дней
-            date_filter = f"WHERE r.created_at >= NOW() - INTERVAL '{days} days'"
-        else:
-            # За всё время
-            date_filter = ""
-        
-        query = f"""
-            SELECT u.user_id, u.username, 
-                   COUNT(r.id) as rep_count,
-                   SUM(CASE WHEN r.text LIKE '%%+%%' OR r.text LIKE '%%+rep%%' OR r.text LIKE '%%+реп%%' THEN 1 ELSE 0 END) as positive_count,
-                   SUM(CASE WHEN r.text LIKE '%%-%%' OR r.text LIKE '%%-rep%%' OR r.text LIKE '%%-реп%%' THEN 1 ELSE 0 END) as negative_count
-            FROM users u
-            LEFT JOIN reputation r ON u.user_id = r.to_user
-            {date_filter}
-            GROUP BY u.user_id, u.username
-            HAVING COUNT(r.id) > 0
-            ORDER BY rep_count DESC
-            LIMIT {limit}
-        """
-        
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        
-        result = []
-        for i, row in enumerate(rows, 1):
-            result.append({
-                'rank': i,
-                'user_id': row[0],
-                'username': row[1] or f"id{row[0]}",
-                'total_reps': row[2],
-                'positive': row[3],
-                'negative': row[4],
-                'percentage': (row[3] / row[2] * 100) if row[2] > 0 else 0
-            })
-        
-        return result
-        
+        with db_connection() as conn:
+            return query_top_users(conn.cursor(), days, limit)
     except Exception as e:
         print(f"❌ Ошибка получения топа: {e}")
         return []
-    finally:
-        conn.close()
-
-def get_daily_top(limit=10):
-    """Топ за день"""
-    return get_top_users_by_period(days=1, limit=limit)
-
-def get_weekly_top(limit=10):
-    """Топ за неделю"""
-    return get_top_users_by_period(days=7, limit=limit)
-
-def get_monthly_top(limit=10):
-    """Топ за месяц"""
-    return get_top_users_by_period(days=30, limit=limit)
-
-def get_all_time_top(limit=10):
-    """Топ за всё время"""
-    return get_top_users_by_period(days=None, limit=limit)
 
 def format_top_message(top_data, period_name):
     """Форматировать сообщение с топом"""
     if not top_data:
-        return f"📊 <b>Топ за {period_name}</b>\n\n📭 Данных пока нет"
+        return f"📊 <b>Топ {period_name}</b>\n\n📭 Данных пока нет"
     
     message = f"🏆 <b>ТОП ПО РЕПУТАЦИИ</b>\n📅 <i>{period_name}</i>\n\n"
     
@@ -569,111 +1448,1246 @@ def format_top_message(top_data, period_name):
     
     return message
 
+# ========== СНИМКИ ТОПОВ ==========
+# Период -> (дней или None за всё время, подпись)
+LEADERBOARD_PERIODS = {
+    'day': (1, "за день"),
+    'week': (7, "за неделю"),
+    'month': (30, "за месяц"),
+    'all': (None, "за всё время"),
+}
+
+# Аргументы /top -> период
+LEADERBOARD_ALIASES = {
+    'day': 'day', 'd': 'day', 'день': 'day', 'сутки': 'day',
+    'week': 'week', 'w': 'week', 'неделя': 'week',
+    'month': 'month', 'm': 'month', 'месяц': 'month',
+    'all': 'all', 'a': 'all', 'всё': 'all', 'все': 'all',
+}
+
+# Период -> {'rows': [...], 'refreshed_at': datetime}; заменяется целиком после пересчёта
+LEADERBOARDS = {}
+
+def refresh_leaderboards(limit=LEADERBOARD_SIZE):
+    """Пересчитать все топы и сохранить снимки одной транзакцией"""
+    boards = {}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT NOW()')
+        refreshed_at = cursor.fetchone()[0]
+
+        for period, (days, _) in LEADERBOARD_PERIODS.items():
+            boards[period] = {'rows': query_top_users(cursor, days, limit), 'refreshed_at': refreshed_at}
+
+        cursor.execute('DELETE FROM leaderboard_snapshots')
+        psycopg2.extras.execute_values(
+            cursor,
+            '''
+                INSERT INTO leaderboard_snapshots
+                    (period, rank, user_id, username, total, positive, negative, refreshed_at)
+                VALUES %s
+            ''',
+            [
+                (period, row['rank'], row['user_id'], row['username'],
+                 row['total_reps'], row['positive'], row['negative'], refreshed_at)
+                for period, board in boards.items()
+                for row in board['rows']
+            ]
+        )
+        conn.commit()
+
+    return boards
+
+def load_leaderboards():
+    """Прочитать последние сохранённые снимки топов (при старте, до первого пересчёта)"""
+    boards = {}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT period, rank, user_id, username, total, positive, negative, refreshed_at
+            FROM leaderboard_snapshots
+            ORDER BY period, rank
+        ''')
+        for period, rank, user_id, username, total, positive, negative, refreshed_at in cursor.fetchall():
+            board = boards.setdefault(period, {'rows': [], 'refreshed_at': refreshed_at})
+            board['rows'].append(top_entry(rank, user_id, username, total, positive, negative))
+
+    return boards
+
+async def update_leaderboards():
+    """Пересчитать топы в фоне и подменить снимки в памяти"""
+    try:
+        boards = await run_db_heavy(refresh_leaderboards)
+        LEADERBOARDS.update(boards)
+    except Exception as e:
+        print(f"❌ Ошибка пересчёта топов: {e}")
+
+async def refresh_leaderboards_job(context: CallbackContext) -> None:
+    """Периодическая задача JobQueue"""
+    await update_leaderboards()
+
+def format_leaderboard(period, limit=LEADERBOARD_SIZE):
+    """Сообщение с топом из снимка в памяти (без запросов к БД)"""
+    days, period_name = LEADERBOARD_PERIODS[period]
+    board = LEADERBOARDS.get(period)
+    if board is None:
+        return f"📊 <b>Топ {period_name}</b>\n\n⏳ Топ ещё считается, попробуйте через минуту"
+
+    message = format_top_message(board['rows'][:limit], period_name).rstrip()
+    message += f"\n\n🕒 Обновлено: {format_datetime(board['refreshed_at'], '%d.%m.%Y %H:%M')}"
+    return message
+
+# ========== РАССЫЛКИ ==========
+def create_broadcast(text, admin_id, include_unreachable=False):
+    """Создать рассылку со списком получателей; вернуть (id, количество)
+
+    По умолчанию пропускает пользователей, отмеченных недоступными после прошлых рассылок.
+    """
+    user_filter = "" if include_unreachable else "WHERE unreachable_reason IS NULL"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO broadcasts (text, admin_id) VALUES (%s, %s) RETURNING id',
+            (text, admin_id)
+        )
+        broadcast_id = cursor.fetchone()[0]
+        cursor.execute(f'''
+            INSERT INTO broadcast_recipients (broadcast_id, user_id)
+            SELECT %s, user_id FROM users {user_filter}
+        ''', (broadcast_id,))
+        total = cursor.rowcount
+        cursor.execute('UPDATE broadcasts SET total = %s WHERE id = %s', (total, broadcast_id))
+        conn.commit()
+
+    return broadcast_id, total
+
+def get_broadcast(broadcast_id):
+    """Рассылка по ID"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, text, admin_id, status, total, sent, failed
+            FROM broadcasts WHERE id = %s
+        ''', (broadcast_id,))
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+    return {'id': row[0], 'text': row[1], 'admin_id': row[2], 'status': row[3],
+            'total': row[4], 'sent': row[5], 'failed': row[6]}
+
+def get_running_broadcasts():
+    """ID незавершённых рассылок (для продолжения после перезапуска)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
+
+def fetch_broadcast_recipients(broadcast_id, after_user_id, limit):
+    """Следующая пачка неотправленных получателей по возрастанию user_id"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = %s AND status = 'p' AND user_id > %s
+            ORDER BY user_id
+            LIMIT %s
+        ''', (broadcast_id, after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+def record_broadcast_results(broadcast_id, results):
+    """Сохранить результаты пачки: [(user_id, status, error, unreachable_reason)]"""
+    if not results:
+        return
+
+    unreachable = [(user_id, reason) for user_id, _, _, reason in results if reason]
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(
+            cursor,
+            '''
+                UPDATE broadcast_recipients AS r
+                SET status = v.status, error = v.error
+                FROM (VALUES %s) AS v (broadcast_id, user_id, status, error)
+                WHERE r.broadcast_id = v.broadcast_id AND r.user_id = v.user_id
+            ''',
+            [(broadcast_id, user_id, status, error) for user_id, status, error, _ in results],
+            template='(%s, %s::bigint, %s, %s)'
+        )
+        cursor.execute('''
+            UPDATE broadcasts SET sent = sent + %s, failed = failed + %s WHERE id = %s
+        ''', (
+            sum(1 for _, status, _, _ in results if status == 's'),
+            sum(1 for _, status, _, _ in results if status == 'f'),
+            broadcast_id
+        ))
+        if unreachable:
+            psycopg2.extras.execute_values(
+                cursor,
+                '''
+                    UPDATE users AS u
+                    SET unreachable_reason = v.reason, unreachable_at = NOW(), updated_at = NOW()
+                    FROM (VALUES %s) AS v (user_id, reason)
+                    WHERE u.user_id = v.user_id
+                ''',
+                unreachable,
+                template='(%s::bigint, %s)'
+            )
+        conn.commit()
+
+def finish_broadcast(broadcast_id):
+    """Отметить рассылку завершённой"""
+    with db_connection() as conn:
+        conn.cursor().execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = NOW() WHERE id = %s",
+            (broadcast_id,)
+        )
+        conn.commit()
+
+def classify_unreachable(error):
+    """Причина, по которой пользователю больше не стоит слать рассылки, или None"""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if 'blocked' in message:
+            return 'blocked'
+        if 'deactivated' in message:
+            return 'deactivated'
+    elif isinstance(error, BadRequest) and 'chat not found' in message:
+        return 'chat_not_found'
+    return None
+
+class RateLimiter:
+    """Общий для всех отправок лимит сообщений в секунду с паузой по flood-wait"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться своего слота"""
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Telegram попросил подождать — откладываем все следующие отправки"""
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+class BroadcastEngine:
+    """Параллельная рассылка в пределах лимита Telegram с сохранением прогресса в БД"""
+
+    def __init__(self, rate, concurrency, batch_size):
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        # broadcast_id -> состояние для отображения прогресса
+        self.active = {}
+        self._tasks = set()
+
+    async def _send(self, bot, user_id, text):
+        """Отправить одно сообщение; вернуть (user_id, статус, ошибка, причина недоступности)"""
+        # Попытки тратят только сетевые ошибки: flood-wait лишь откладывает отправку
+        attempt = 0
+        while attempt < 5:
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                return (user_id, 's', None, None)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.limiter.pause(retry_after + 1)
+            except (Forbidden, BadRequest) as e:
+                return (user_id, 'f', str(e)[:200], classify_unreachable(e))
+            except NetworkError:
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+            except TelegramError as e:
+                return (user_id, 'f', str(e)[:200], None)
+
+        return (user_id, 'f', 'retries exhausted', None)
+
+    async def _send_batch(self, bot, broadcast_id, user_ids, text, state):
+        """Отправить пачку параллельно; результаты сохраняются даже при остановке посередине"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = []
+
+        async def worker(user_id):
+            async with semaphore:
+                result = await self._send(bot, user_id, text)
+            results.append(result)
+            state['sent' if result[1] == 's' else 'failed'] += 1
+
+        tasks = [asyncio.create_task(worker(user_id)) for user_id in user_ids]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await run_db(record_broadcast_results, broadcast_id, results)
+
+    async def run(self, bot, broadcast_id, progress=None):
+        """Разослать оставшимся получателям; progress(state) вызывается не чаще раза в 3 секунды"""
+        broadcast = await run_db(get_broadcast, broadcast_id)
+        if not broadcast or broadcast['status'] != 'running':
+            return broadcast
+
+        state = {
+            'id': broadcast_id,
+            'total': broadcast['total'],
+            'sent': broadcast['sent'],
+            'failed': broadcast['failed'],
+            'started_done': broadcast['sent'] + broadcast['failed'],
+            'started_at': time.monotonic(),
+        }
+        self.active[broadcast_id] = state
+        last_progress = 0.0
+        after_user_id = 0
+
+        try:
+            while True:
+                user_ids = await run_db(fetch_broadcast_recipients, broadcast_id, after_user_id, self.batch_size)
+                if not user_ids:
+                    break
+
+                await self._send_batch(bot, broadcast_id, user_ids, broadcast['text'], state)
+                after_user_id = user_ids[-1]
+
+                if progress and time.monotonic() - last_progress >= 3:
+                    last_progress = time.monotonic()
+                    await progress(state)
+
+            await run_db(finish_broadcast, broadcast_id)
+        finally:
+            self.active.pop(broadcast_id, None)
+
+        if progress:
+            await progress(state)
+        return state
+
+    def start(self, application, broadcast_id):
+        """Запустить рассылку в фоне с прогрессом в сообщении админу
+        
+        Не через application.create_task: Application.stop() ждёт такие задачи до конца,
+        и долгая рассылка задержала бы выключение. Эти задачи отменяет stop() из post_stop.
+        """
+        task = asyncio.create_task(self._run_with_report(application.bot, broadcast_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Остановить рассылки перед выключением: отправленное сохраняется, остальное — после перезапуска"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run_with_report(self, bot, broadcast_id):
+        broadcast = await run_db(get_broadcast, broadcast_id)
+        if not broadcast:
+            return
+
+        try:
+            status_msg = await bot.send_message(
+                chat_id=broadcast['admin_id'],
+                text=f"Рассылка #{broadcast_id}: запуск..."
+            )
+        except TelegramError as e:
+            print(f"❌ Не удалось отправить статус рассылки #{broadcast_id}: {e}")
+            status_msg = None
+
+        async def progress(state):
+            if status_msg is None:
+                return
+            try:
+                await status_msg.edit_text(format_broadcast_progress(state))
+            except TelegramError:
+                pass
+
+        try:
+            await self.run(bot, broadcast_id, progress)
+        except asyncio.CancelledError:
+            print(f"⏸ Рассылка #{broadcast_id} остановлена, продолжится после перезапуска")
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка рассылки #{broadcast_id}: {e}")
+
+    async def resume_all(self, application):
+        """Продолжить рассылки, прерванные перезапуском"""
+        for broadcast_id in await run_db(get_running_broadcasts):
+            print(f"▶️ Продолжаю рассылку #{broadcast_id}")
+            self.start(application, broadcast_id)
+
+def format_broadcast_progress(state):
+    """Текст прогресса рассылки: отправлено, скорость, оставшееся время"""
+    done = state['sent'] + state['failed']
+    total = state['total']
+    elapsed = time.monotonic() - state['started_at']
+    rate = (done - state['started_done']) / elapsed if elapsed > 0 else 0
+
+    if done >= total:
+        header = f"✅ Рассылка #{state['id']} завершена"
+        eta = ""
+    else:
+        header = f"Рассылка #{state['id']}... {done}/{total}"
+        remaining = (total - done) / rate if rate > 0 else None
+        eta = f"\nОсталось: ~{format_duration(remaining)}" if remaining is not None else ""
+
+    return (
+        f"{header}\n"
+        f"Успешно: {state['sent']}\n"
+        f"Ошибок: {state['failed']}\n"
+        f"Скорость: {rate:.1f} сообщ./с"
+        f"{eta}"
+    )
+
+def format_duration(seconds):
+    """Длительность в виде «1 ч 5 мин» / «3 мин» / «20 с»"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин"
+    return f"{seconds} с"
+
+broadcast_engine = BroadcastEngine(BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH_SIZE)
+
 # ========== РЕЗЕРВНОЕ КОПИРОВАНИЕ ==========
+# Таблицы в бэкапе: (таблица, колонки, первичный ключ — он же порядок выгрузки)
+BACKUP_TABLES = [
+    ('users', ('user_id', 'username', 'registered_at', 'unreachable_reason', 'unreachable_at', 'updated_at'), 'user_id'),
+    ('reputation', ('id', 'from_user', 'to_user', 'text', 'photo_id', 'created_at', 'polarity'), 'id'),
+]
+
+BACKUP_TABLE_NAMES = {table for table, _, _ in BACKUP_TABLES}
+BACKUP_TABLE_KEYS = {table: key for table, _, key in BACKUP_TABLES}
+BACKUP_TABLE_COLUMNS = {table: set(columns) for table, columns, _ in BACKUP_TABLES}
+BACKUP_TABLE_COLUMNS['reputation_deletions'] = {'rep_id'}
+
+# Архив .tar: manifest.json и по сжатому CSV-потоку COPY на таблицу (или кусок reputation).
+# Старые .sql.gz (COPY-секции или INSERT-ы) по-прежнему восстанавливаются
+BACKUP_EXTENSIONS = ('.tar', '.sql.gz')
+BACKUP_ARCHIVE_FORMAT = 'tar-csv'
+BACKUP_ARCHIVE_MANIFEST = 'manifest.json'
+
+# Что попадает в инкремент: строки, изменённые после снимка предыдущего бэкапа
+BACKUP_INCREMENT_FILTERS = {
+    'users': 'updated_at > %(since)s',
+    'reputation': 'id > %(max_id)s',
+}
+
+# Запас на транзакции, начатые до снимка предыдущего бэкапа и завершённые после него.
+# Лишние строки безопасны: инкремент применяется через INSERT ... ON CONFLICT
+BACKUP_INCREMENT_OVERLAP = timedelta(minutes=5)
+BACKUP_INCREMENT_OVERLAP_IDS = 100
+
+# Начало секции COPY и таблица из INSERT старого формата
+BACKUP_COPY_RE = re.compile(r'^COPY (\w+) \(([\w, ]+)\) FROM stdin;$')
+BACKUP_INSERT_RE = re.compile(r'^INSERT INTO (\w+)', re.IGNORECASE)
+BACKUP_LEGACY_NULL_RE = re.compile(r"(?<=[(,] )'NULL'(?=[,)])")
+
+class CopySectionReader:
+    """Файловый объект для copy_expert: строки секции COPY до маркера \\."""
+
+    def __init__(self, f):
+        self.f = f
+        self.done = False
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            line = self.f.readline()
+            if not line:
+                raise ValueError("Бэкап обрывается посреди секции COPY")
+            if line == '\\.\n' or line == '\\.':
+                self.done = True
+                break
+            self.buffer += line
+
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+class HashingReader:
+    """Файловый объект: читает из f и считает SHA-256 прочитанного"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.sha256.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        """SHA-256 всего потока: непрочитанный остаток дочитывается"""
+        while self.read(1024 * 1024):
+            pass
+        return self.sha256.hexdigest()
+
+def file_sha256(path):
+    """SHA-256 файла"""
+    with open(path, 'rb') as f:
+        return HashingReader(f).hexdigest()
+
+def backup_label(filename):
+    """Имя бэкапа для списков: без префикса backup_ и расширения"""
+    for extension in BACKUP_EXTENSIONS:
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+            break
+    return filename[7:] if filename.startswith('backup_') else filename
+
+def begin_backup_snapshot(cursor, snapshot_id=None):
+    """Начать транзакцию бэкапа: согласованный снимок только для чтения (или чужой экспортированный)"""
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+    if snapshot_id:
+        cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+    cursor.execute("SET LOCAL DateStyle = 'ISO'")
+
+def read_backup_manifest(filepath):
+    """Манифест бэкапа из файла рядом с ним, для .tar — из самого архива; иначе None"""
+    try:
+        with open(filepath + '.json', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    if not filepath.endswith('.tar'):
+        return None
+    try:
+        with tarfile.open(filepath, 'r:') as tar:
+            manifest = read_archive_manifest(tar)
+    except (OSError, tarfile.TarError, ValueError):
+        return None
+    manifest['size'] = os.path.getsize(filepath)
+    return manifest
+
+def read_archive_manifest(tar):
+    """manifest.json из открытого архива .tar"""
+    try:
+        f = tar.extractfile(BACKUP_ARCHIVE_MANIFEST)
+    except KeyError:
+        f = None
+    if f is None:
+        raise ValueError("В архиве нет manifest.json")
+    manifest = json.load(f)
+    if manifest.get('format') != BACKUP_ARCHIVE_FORMAT:
+        raise ValueError(f"Неизвестный формат архива: {manifest.get('format')}")
+    return manifest
+
+def write_backup_manifest(filepath, manifest):
+    """Сохранить манифест рядом с файлом бэкапа"""
+    tmp_path = filepath + '.json.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, filepath + '.json')
+
+class BackupProgress:
+    """Прогресс долгой операции с бэкапом: пишется из рабочего потока, показывается правкой сообщения"""
+
+    def __init__(self, msg, label):
+        self.msg = msg
+        self.label = label
+        self.done = 0
+        self.total = 0
+
+    def __call__(self, done, total):
+        self.done, self.total = done, total
+
+    async def track(self, awaitable):
+        """Дождаться операции, раз в BACKUP_PROGRESS_INTERVAL секунд обновляя процент в сообщении"""
+        task = asyncio.ensure_future(awaitable)
+        shown = None
+        while not task.done():
+            await asyncio.wait([task], timeout=BACKUP_PROGRESS_INTERVAL)
+            if task.done() or not self.total:
+                continue
+            percent = self.done * 100 // self.total
+            # Telegram отклоняет правку без изменений
+            if percent != shown:
+                shown = percent
+                try:
+                    await self.msg.edit_text(f"{self.label}... {percent}%")
+                except TelegramError:
+                    pass
+        return task.result()
+
 class SimpleBackup:
     def __init__(self):
         self.backup_dir = "database_backups"
+        self.index_path = os.path.join(self.backup_dir, "index.json")
         os.makedirs(self.backup_dir, exist_ok=True)
+        self._index_lock = threading.RLock()
+        # Ручной и плановый бэкап не должны выгружаться одновременно
+        self._backup_lock = asyncio.Lock()
+    
+    async def create_backup(self, update: Update, context: CallbackContext, incremental=False):
+        """Создать бэкап базы данных: полный или только изменения с прошлого бэкапа"""
+        user_id = update.effective_user.id
+        
+        if user_id not in ADMINS:
+            await update.message.reply_text("❌ Доступ запрещен")
+            return
+        
+        msg = await update.message.reply_text("Создание бэкапа...")
+        
+        try:
+            progress = BackupProgress(msg, "Создание бэкапа")
+            manifest = await progress.track(self.make_backup(incremental, progress))
+            if manifest is None:
+                await msg.edit_text("Инкремент не от чего считать: сначала создайте полный бэкап")
+                return
+            
+            counts = manifest['counts']
+            size_mb = manifest['size'] / (1024 * 1024)
+            
+            if incremental:
+                records = (
+                    f"📊 Изменений: {counts['users']} пользователей, {counts['reputation']} отзывов, "
+                    f"{counts['reputation_deletions']} удалений\n"
+                    f"🔗 База: {manifest['base']}"
+                )
+            else:
+                records = f"📊 Записей: {counts['users']} пользователей, {counts['reputation']} отзывов"
+            
+            # Просто показываем сообщение без кнопок, так как это edit_text
+            await msg.edit_text(
+                f"✅ {'Инкрементальный бэкап' if incremental else 'Бэкап'} создан\n"
+                f"📁 Файл: {manifest['file']}\n"
+                f"📊 Размер: {size_mb:.2f} MB\n"
+                f"📅 Дата: {datetime.now().strftime('%d.%m %H:%M')}\n"
+                f"{records}"
+            )
+            
+            # Отправляем отдельное сообщение с меню
+            await update.message.reply_text(
+                "Что дальше?",
+                reply_markup=get_backup_menu_keyboard()
+            )
+            
+        except Exception as e:
+            print(f"❌ ОШИБКА в create_backup: {e}")
+            import traceback
+            traceback.print_exc()
+            await msg.edit_text(f"Ошибка: {str(e)[:200]}")
     
-    async def create_backup(self, update: Update, context: CallbackContext):
-        """Создать бэкап базы данных (Python версия)"""
-        user_id = update.effective_user.id
+    async def make_backup(self, incremental=False, progress=None):
+        """Создать бэкап; вернуть манифест или None, если инкремент делать не от чего"""
+        async with self._backup_lock:
+            parent = None
+            if incremental:
+                parent = await run_backup_io(self.latest_manifest)
+                if parent is None:
+                    return None
+            
+            timestamp = datetime.now().strftime("%d%m%y_%H%M%S")
+            filename = f"backup_{timestamp}{'_inc' if incremental else ''}.tar"
+            filepath = os.path.join(self.backup_dir, filename)
+            
+            print(f"💾 Создание бэкапа: {filepath}")
+            
+            # Выгрузка идёт в потоке бэкапов, строки через COPY сразу сжимаются в файл
+            manifest = await run_backup_io(self.dump_to_file, filepath, parent, progress=progress)
+            
+            print(f"✅ Бэкап создан: {filename}, размер: {manifest['size'] / (1024 * 1024):.2f} MB")
+            return manifest
+    
+    async def run_scheduled(self):
+        """Плановый бэкап: полный раз в BACKUP_FULL_INTERVAL_HOURS, между ними — инкременты; затем очистка"""
+        entries = await run_backup_io(self.load_index)
+        last_full = next((entry for entry in entries if entry['type'] == 'full' and not entry.get('legacy')), None)
         
-        if user_id not in ADMINS:
-            await update.message.reply_text("❌ Доступ запрещен")
-            return
+        manifest = None
+        if last_full and backup_age_hours(last_full) < BACKUP_FULL_INTERVAL_HOURS:
+            manifest = await self.make_backup(incremental=True)
+        if manifest is None:
+            manifest = await self.make_backup()
         
-        msg = await update.message.reply_text("Создание бэкапа...")
+        deleted, freed = await run_backup_io(self.apply_retention)
+        if deleted:
+            print(f"🧹 Удалено старых бэкапов: {deleted}, освобождено {freed / (1024 * 1024):.1f} MB")
+        return manifest
+    
+    async def verify_latest(self, progress=None):
+        """Проверить самый свежий бэкап вместе с его цепочкой; None, если бэкапов нет"""
+        async with self._backup_lock:
+            entries = await run_backup_io(self.load_index)
+            if not entries:
+                return None
+            
+            filepath = os.path.join(self.backup_dir, entries[0]['file'])
+            try:
+                chain = await run_backup_io(self.resolve_chain, filepath)
+            except ValueError as e:
+                return {'file': entries[0]['file'], 'chain': 0, 'sections': 0, 'problems': [str(e)], 'seconds': 0}
+            
+            report = await run_backup_io(self.verify_chain, chain, progress)
+            print(f"{'✅' if not report['problems'] else '❌'} Проверка бэкапа {report['file']}: {report['problems'] or 'в порядке'}")
+            return report
+    
+    def dump_to_file(self, filepath, parent=None, workers=BACKUP_WORKERS, record=True, progress=None):
+        """Записать полный бэкап или инкремент от манифеста parent в архив .tar; вернуть манифест
+        
+        В архиве manifest.json (строки и SHA-256 каждой секции) и секции — CSV-потоки COPY
+        в gzip. Все таблицы читаются из одного снимка REPEATABLE READ READ ONLY, без блокировок
+        для пишущих транзакций. При workers > 1 (не больше BACKUP_POOL_HEADROOM) снимок
+        экспортируется, таблицы и куски reputation по диапазонам id выгружаются на workers
+        соединениях. Каждая секция потоком сжимается в свой файл, память не растёт с таблицей;
+        zlib отпускает GIL, так что потоки сжимают параллельно.
+        record=False — только файл, без учёта в цепочке и индексе.
+        progress(готово, всего секций) вызывается из рабочего потока.
+        """
+        tmp_path = filepath + '.tmp'
+        filename = os.path.basename(filepath)
+        workers = min(workers, BACKUP_POOL_HEADROOM)
+        manifest = {
+            'format': BACKUP_ARCHIVE_FORMAT,
+            'type': 'incremental' if parent else 'full',
+            'file': filename,
+            'base': parent['base'] if parent else filename,
+            'parent': parent['file'] if parent else None,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'counts': {},
+            'sections': [],
+        }
+        # Каждая секция пишется в отдельный gzip-файл, затем части собираются в архив
+        part_paths = []
         
         try:
-            print("1. Начинаю создание бэкапа...")
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                begin_backup_snapshot(cursor)
+                cursor.execute('SELECT NOW(), COALESCE(MAX(id), 0) FROM reputation')
+                snapshot_time, max_id = cursor.fetchone()
+                manifest['snapshot_time'] = snapshot_time.isoformat()
+                manifest['max_reputation_id'] = max_id
+                
+                parallel = workers > 1
+                sections = self._backup_sections(cursor, parent, BACKUP_CHUNK_ROWS if parallel else None)
+                for i in range(len(sections)):
+                    part_paths.append(f"{tmp_path}.{i}")
+                # Последний шаг прогресса — сборка архива
+                steps = len(sections) + 1
+                rows = []
+                
+                if parallel and len(sections) > 1:
+                    # Снимок живёт, пока открыта эта транзакция — она ждёт выгрузки всех секций
+                    cursor.execute('SELECT pg_export_snapshot()')
+                    snapshot_id = cursor.fetchone()[0]
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup') as pool:
+                        futures = [
+                            pool.submit(self._dump_section_in_snapshot, snapshot_id, part_path, *section)
+                            for part_path, section in zip(part_paths, sections)
+                        ]
+                        for future in futures:
+                            rows.append(future.result())
+                            if progress:
+                                progress(len(rows), steps)
+                else:
+                    for part_path, section in zip(part_paths, sections):
+                        rows.append(self._dump_section(cursor, part_path, *section))
+                        if progress:
+                            progress(len(rows), steps)
+                conn.rollback()
             
-            timestamp = datetime.now().strftime("%d%m%y_%H%M")
-            filename = f"backup_{timestamp}.sql"
-            filepath = os.path.join(self.backup_dir, filename)
+            chunks = {}
+            for part_path, (table, columns, _), count in zip(part_paths, sections, rows):
+                manifest['counts'][table] = manifest['counts'].get(table, 0) + count
+                chunks[table] = chunks.get(table, 0) + 1
+                manifest['sections'].append({
+                    'name': f"{table}.{chunks[table]:04d}.csv.gz",
+                    'table': table,
+                    'columns': list(columns),
+                    'rows': count,
+                    'size': os.path.getsize(part_path),
+                    'sha256': file_sha256(part_path),
+                })
+            
+            # Манифест — первым, чтобы при чтении архива он был известен до секций
+            with tarfile.open(tmp_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+                data = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+                info = tarfile.TarInfo(BACKUP_ARCHIVE_MANIFEST)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+                for part_path, section in zip(part_paths, manifest['sections']):
+                    tar.add(part_path, arcname=section['name'], recursive=False)
+            
+            # Неполный файл не попадёт в список бэкапов
+            os.replace(tmp_path, filepath)
+        finally:
+            for path in [tmp_path] + part_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        
+        manifest['size'] = os.path.getsize(filepath)
+        if progress:
+            progress(steps, steps)
+        if not record:
+            return manifest
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if not parent:
+                # Удаления до полного бэкапа уже учтены в нём самом
+                cursor.execute(
+                    'DELETE FROM reputation_deletions WHERE deleted_at < %s',
+                    (snapshot_time - BACKUP_INCREMENT_OVERLAP,)
+                )
+            # От этого бэкапа будет считаться следующий инкремент
+            set_setting(cursor, 'last_backup_file', filename)
+            conn.commit()
+        
+        write_backup_manifest(filepath, manifest)
+        self.add_to_index(manifest)
+        return manifest
+    
+    def _backup_sections(self, cursor, parent, chunk_rows=None):
+        """Секции бэкапа: [(таблица, колонки, запрос)]; для инкремента — только изменения
+        
+        С chunk_rows полный reputation делится на секции по диапазонам id.
+        """
+        if parent:
+            since = {
+                'since': datetime.fromisoformat(parent['snapshot_time']) - BACKUP_INCREMENT_OVERLAP,
+                'max_id': parent['max_reputation_id'] - BACKUP_INCREMENT_OVERLAP_IDS,
+            }
+        
+        sections = []
+        for table, columns, key in BACKUP_TABLES:
+            query = f"SELECT {', '.join(columns)} FROM {table}"
             
-            print(f"2. Файл: {filepath}")
+            if table == 'reputation' and chunk_rows and not parent:
+                cursor.execute('SELECT MIN(id), MAX(id) FROM reputation')
+                min_id, max_id = cursor.fetchone()
+                if min_id is not None and max_id - min_id >= chunk_rows:
+                    for start in range(min_id, max_id + 1, chunk_rows):
+                        sections.append((table, columns, (
+                            f"{query} WHERE id BETWEEN {start} AND {start + chunk_rows - 1} ORDER BY {key}"
+                        )))
+                    continue
             
-            conn = get_db_connection()
+            if parent:
+                query += " WHERE " + cursor.mogrify(BACKUP_INCREMENT_FILTERS[table], since).decode('utf-8')
+            query += f" ORDER BY {key}"
+            sections.append((table, columns, query))
+        
+        if parent:
+            query = cursor.mogrify(
+                'SELECT rep_id FROM reputation_deletions WHERE deleted_at > %(since)s ORDER BY rep_id', since
+            ).decode('utf-8')
+            sections.append(('reputation_deletions', ('rep_id',), query))
+        
+        return sections
+    
+    def _dump_section_in_snapshot(self, snapshot_id, part_path, table, columns, query):
+        """Выгрузить секцию на отдельном соединении в экспортированном снимке"""
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            begin_backup_snapshot(cursor, snapshot_id)
+            rows = self._dump_section(cursor, part_path, table, columns, query)
+            conn.rollback()
+        return rows
+    
+    def _dump_section(self, cursor, part_path, table, columns, query):
+        """Секция в отдельный gzip-файл: строки потоком, без буфера в памяти"""
+        with gzip.open(part_path, 'wb', compresslevel=BACKUP_COMPRESSLEVEL) as f:
+            return self._write_section(cursor, f, table, columns, query)
+    
+    def _write_section(self, cursor, f, table, columns, query):
+        """Строки запроса в CSV с заголовком из имён колонок; вернуть число строк"""
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT csv, HEADER)", f)
+        return cursor.rowcount
+    
+    def restore_chain(self, chain, progress=None):
+        """Восстановить полный бэкап и его инкременты по порядку одной транзакцией
+        
+        Вернуть количество строк по таблицам после восстановления.
+        progress(прочитано, всего байт) вызывается из рабочего потока по мере чтения файлов.
+        """
+        with db_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("SET LOCAL DateStyle = 'ISO'")
+            # Даты без пояса в старых бэкапах — в поясе бота, как при миграции на TIMESTAMPTZ
+            cursor.execute("SELECT set_config('TimeZone', %s, true)", (BOT_TIMEZONE,))
+            # Старые данные удаляются в той же транзакции: при ошибке база останется как была
+            cursor.execute(f"TRUNCATE TABLE {', '.join(BACKUP_TABLE_NAMES)}, reputation_deletions")
+            # После восстановления инкремент не от чего считать — следующим нужен полный бэкап
+            cursor.execute("DELETE FROM bot_settings WHERE key = 'last_backup_file'")
             
-            print("3. Подключился к базе")
+            self._load_chain(cursor, chain, progress)
             
-            # Создаём SQL файл вручную
-            with open(filepath, 'w', encoding='utf-8') as f:
-                # 1. Заголовок
-                f.write(f"-- Backup TESS Reputation Bot\n")
-                f.write(f"-- Created: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+            # Как в миграции 7: курсоры страниц не работают с NULL в created_at
+            cursor.execute("UPDATE reputation SET created_at = to_timestamp(0) WHERE created_at IS NULL")
+            
+            # Следующий отзыв получит id после восстановленных
+            cursor.execute('''
+                SELECT setval(pg_get_serial_sequence('reputation', 'id'), COALESCE(MAX(id), 0) + 1, false)
+                FROM reputation
+            ''')
+            
+            counts = self._count_rows(cursor)
+            conn.commit()
+        
+        return counts
+    
+    def verify_chain(self, chain, progress=None):
+        """Восстановить цепочку во временную схему, сверить с манифестом и живыми таблицами; вернуть отчёт
+        
+        Схема создаётся внутри транзакции и исчезает при откате: рабочие таблицы только читаются.
+        """
+        started = time.monotonic()
+        schema = f"backup_verify_{os.getpid()}"
+        last = read_backup_manifest(chain[-1])
+        report = {'file': os.path.basename(chain[-1]), 'chain': len(chain), 'sections': 0, 'problems': []}
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SET LOCAL DateStyle = 'ISO'")
+                cursor.execute("SELECT set_config('TimeZone', %s, true)", (BOT_TIMEZONE,))
+                cursor.execute('SELECT current_schema()')
+                live_schema = cursor.fetchone()[0]
                 
-                print("4. Начинаю выгрузку users...")
-                # 2. Таблица users
-                cursor.execute("SELECT * FROM users")
-                users = cursor.fetchall()
-                print(f"5. Нашёл {len(users)} пользователей")
+                cursor.execute(f"CREATE SCHEMA {schema}")
+                for table, _, key in BACKUP_TABLES:
+                    cursor.execute(
+                        f"CREATE TABLE {schema}.{table} (LIKE {live_schema}.{table} INCLUDING DEFAULTS, PRIMARY KEY ({key}))"
+                    )
+                # Инкременты берут из неё типы колонок для секции удалений
+                cursor.execute(f"CREATE TABLE {schema}.reputation_deletions (LIKE {live_schema}.reputation_deletions)")
+                # Таблицы без схемы в секциях и в INSERT-ах старого формата — временные
+                cursor.execute(f"SET LOCAL search_path = {schema}")
                 
-                f.write("-- Table: users\n")
-                f.write("TRUNCATE TABLE users CASCADE;\n")
-                for user in users:
-                    user_id_db = user[0]
-                    username = str(user[1]).replace("'", "''") if user[1] else "NULL"
-                    registered_at = str(user[2]).replace("'", "''") if user[2] else "NULL"
-                    f.write(f"INSERT INTO users (user_id, username, registered_at) VALUES ({user_id_db}, '{username}', '{registered_at}');\n")
+                report['sections'] = self._load_chain(cursor, chain, progress)
                 
-                print("6. Начинаю выгрузку reputation...")
-                # 3. Таблица reputation
-                cursor.execute("SELECT * FROM reputation ORDER BY id")
-                reps = cursor.fetchall()
-                print(f"7. Нашёл {len(reps)} отзывов")
+                cursor.execute("UPDATE reputation SET created_at = to_timestamp(0) WHERE created_at IS NULL")
+                report['counts'] = self._count_rows(cursor)
                 
-                f.write("\n-- Table: reputation\n")
-                f.write("TRUNCATE TABLE reputation CASCADE;\n")
-                for rep in reps:
-                    rep_id = rep[0]
-                    from_user = rep[1] if rep[1] is not None else "NULL"
-                    to_user = rep[2]
-                    text = str(rep[3]).replace("'", "''") if rep[3] else "NULL"
-                    photo_id = str(rep[4]).replace("'", "''") if rep[4] else "NULL"
-                    created_at = str(rep[5]).replace("'", "''") if rep[5] else "NULL"
-                    f.write(f"INSERT INTO reputation (id, from_user, to_user, text, photo_id, created_at) VALUES ({rep_id}, {from_user}, {to_user}, '{text}', '{photo_id}', '{created_at}');\n")
-            
-            conn.close()
-            print("8. База закрыта")
+                # Отзывы не меняются: до последнего id из бэкапа живая таблица должна совпасть,
+                # если после бэкапа ничего не удаляли
+                if last and 'max_reputation_id' in last:
+                    columns = ', '.join(next(columns for table, columns, _ in BACKUP_TABLES if table == 'reputation'))
+                    sums = []
+                    for table_schema in (schema, live_schema):
+                        cursor.execute(f'''
+                            SELECT COUNT(*), COALESCE(SUM(('x' || left(md5(ROW({columns})::text), 16))::bit(64)::bigint), 0)
+                            FROM {table_schema}.reputation WHERE id <= %s
+                        ''', (last['max_reputation_id'],))
+                        sums.append(cursor.fetchone())
+                    report['live'] = {
+                        'max_id': last['max_reputation_id'],
+                        'backup_rows': sums[0][0],
+                        'live_rows': sums[1][0],
+                        'match': sums[0] == sums[1],
+                    }
+            except (ValueError, OSError, tarfile.TarError, psycopg2.Error) as e:
+                report['problems'].append(str(e).strip().splitlines()[0][:300])
+            finally:
+                conn.rollback()
             
-            # Архивируем
-            with open(filepath, 'rb') as f_in:
-                with gzip.open(filepath + '.gz', 'wb') as f_out:
-                    f_out.write(f_in.read())
+            set_setting(cursor, 'last_backup_verify', datetime.now(timezone.utc).isoformat())
+            conn.commit()
+        
+        report['seconds'] = time.monotonic() - started
+        return report
+    
+    def _load_chain(self, cursor, chain, progress=None):
+        """Загрузить файлы цепочки по порядку; вернуть число секций, сверенных по SHA-256
+        
+        После полного бэкапа число строк сверяется с его манифестом.
+        progress(прочитано, всего байт) вызывается по мере чтения файлов.
+        """
+        sizes = [os.path.getsize(path) for path in chain]
+        total_bytes = sum(sizes)
+        done_bytes = 0
+        sections = 0
+        
+        for i, path in enumerate(chain):
+            file_progress = None
+            if progress:
+                file_progress = lambda done, offset=done_bytes: progress(offset + done, total_bytes)
+            sections += self._load_archive(cursor, path, incremental=i > 0, progress=file_progress)
+            done_bytes += sizes[i]
             
-            # Удаляем несжатый файл
-            os.remove(filepath)
-            filepath = filepath + '.gz'
-            filename = filename + '.gz'
+            expected = (read_backup_manifest(path) or {}).get('counts') if i == 0 else None
+            if expected:
+                counts = self._count_rows(cursor)
+                for table, rows in expected.items():
+                    if counts.get(table) != rows:
+                        raise ValueError(f"{table}: восстановлено {counts.get(table)} строк, в манифесте {rows}")
+        
+        if progress:
+            progress(total_bytes, total_bytes)
+        return sections
+    
+    def _count_rows(self, cursor):
+        """Число строк в таблицах бэкапа (в схеме из search_path)"""
+        counts = {}
+        for table in BACKUP_TABLE_NAMES:
+            cursor.execute(f'SELECT COUNT(*) FROM {table}')
+            counts[table] = cursor.fetchone()[0]
+        return counts
+    
+    def _load_archive(self, cursor, filepath, incremental, progress=None):
+        """Прочитать один файл бэкапа: архив .tar или .sql.gz старых форматов
+        
+        Вернуть число секций, сверенных по SHA-256 (в .sql.gz контрольных сумм нет).
+        """
+        if filepath.endswith('.tar'):
+            return self._load_tar(cursor, filepath, incremental, progress)
+        self._load_sql(cursor, filepath, incremental, progress)
+        return 0
+    
+    def _load_tar(self, cursor, filepath, incremental, progress=None):
+        """Загрузить секции архива .tar, сверяя число строк и SHA-256 с манифестом
+        
+        Несовпадение — исключение: вызывающая транзакция откатывается целиком.
+        """
+        with tarfile.open(filepath, 'r:') as tar:
+            manifest = read_archive_manifest(tar)
+            if (manifest['type'] == 'incremental') != incremental:
+                raise ValueError(f"Бэкап {manifest['file']} не на своём месте в цепочке")
             
-            size_bytes = os.path.getsize(filepath)
-            size_mb = size_bytes / (1024 * 1024)
+            for section in manifest['sections']:
+                table = section['table']
+                allowed = BACKUP_TABLE_NAMES | ({'reputation_deletions'} if incremental else set())
+                if table not in allowed or not set(section['columns']) <= BACKUP_TABLE_COLUMNS[table]:
+                    raise ValueError(f"Неизвестная таблица в бэкапе: {table}")
+                
+                try:
+                    member = tar.extractfile(section['name'])
+                except KeyError:
+                    member = None
+                if member is None:
+                    raise ValueError(f"В архиве нет секции {section['name']}")
+                
+                source = HashingReader(member)
+                with gzip.open(source, 'rb') as data:
+                    rows = self._copy_in(
+                        cursor, table, ', '.join(section['columns']), data, incremental,
+                        options=' (FORMAT csv, HEADER)'
+                    )
+                if source.hexdigest() != section['sha256']:
+                    raise ValueError(f"Контрольная сумма не совпадает: {section['name']}")
+                if rows != section['rows']:
+                    raise ValueError(f"В секции {section['name']} {rows} строк вместо {section['rows']}")
+                
+                if progress:
+                    progress(tar.fileobj.tell())
             
-            print(f"9. Бэкап создан: {filename}, размер: {size_mb} MB")
+            return len(manifest['sections'])
+    
+    def _load_sql(self, cursor, filepath, incremental, progress=None):
+        """Прочитать .sql.gz: секции COPY или INSERT-ы старого формата"""
+        with open(filepath, 'rb') as raw, gzip.open(raw, 'rt', encoding='utf-8') as f:
+            statement = []
+            in_quotes = False
+            inserted = 0
             
-            # Просто показываем сообщение без кнопок, так как это edit_text
-            await msg.edit_text(
-                f"✅ Бэкап создан\n"
-                f"📁 Файл: {filename}\n"
-                f"📊 Размер: {size_mb:.2f} MB\n"
-                f"📅 Дата: {datetime.now().strftime('%d.%m %H:%M')}\n"
-                f"📊 Записей: {len(users)} пользователей, {len(reps)} отзывов"
-            )
+            for line in f:
+                if not statement:
+                    if line.startswith('--') or not line.strip():
+                        continue
+                    
+                    copy_match = BACKUP_COPY_RE.match(line)
+                    if copy_match:
+                        table = copy_match.group(1)
+                        allowed = BACKUP_TABLE_NAMES | ({'reputation_deletions'} if incremental else set())
+                        if table not in allowed:
+                            raise ValueError(f"Неизвестная таблица в бэкапе: {table}")
+                        self._copy_in(cursor, table, copy_match.group(2), CopySectionReader(f), incremental)
+                        if progress:
+                            progress(raw.tell())
+                        continue
+                
+                # Старый формат: INSERT-ы, текст отзыва может содержать ; и переводы строк
+                statement.append(line)
+                in_quotes ^= line.count("'") % 2 == 1
+                if in_quotes or not line.rstrip().endswith(';'):
+                    continue
+                
+                sql = ''.join(statement).strip()
+                statement = []
+                if sql.upper().startswith('TRUNCATE'):
+                    continue
+                if incremental or not BACKUP_INSERT_RE.match(sql):
+                    raise ValueError(f"Неожиданная команда в бэкапе: {sql[:50]}")
+                # Ранние бэкапы писали NULL как строку 'NULL' — в дату она не превратится
+                cursor.execute(BACKUP_LEGACY_NULL_RE.sub('NULL', sql))
+                
+                inserted += 1
+                if progress and inserted % 1000 == 0:
+                    progress(raw.tell())
             
-            # Отправляем отдельное сообщение с меню
-            await update.message.reply_text(
-                "Что дальше?",
-                reply_markup=get_backup_menu_keyboard()
-            )
+            if statement:
+                raise ValueError("Бэкап обрывается посреди SQL-команды")
+    
+    def _copy_in(self, cursor, table, column_list, section, incremental, options=''):
+        """Загрузить секцию COPY: в полном бэкапе — прямо в таблицу, в инкременте — через временную
+        
+        Вернуть число строк в секции.
+        """
+        if not incremental:
+            cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN{options}", section)
+            return cursor.rowcount
+        
+        stage = f"restore_{table}"
+        # Только типы колонок, без ограничений: в секции может быть часть колонок
+        cursor.execute(f"DROP TABLE IF EXISTS {stage}")
+        cursor.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT {column_list} FROM {table} WITH NO DATA")
+        cursor.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN{options}", section)
+        rows = cursor.rowcount
+        
+        if table == 'reputation_deletions':
+            cursor.execute(f"DELETE FROM reputation WHERE id IN (SELECT rep_id FROM {stage})")
+            return rows
+        
+        key = BACKUP_TABLE_KEYS[table]
+        columns = [column.strip() for column in column_list.split(',')]
+        updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column != key)
+        cursor.execute(f'''
+            INSERT INTO {table} ({column_list})
+            SELECT {column_list} FROM {stage}
+            ON CONFLICT ({key}) DO UPDATE SET {updates}
+        ''')
+        return rows
+    
+    def latest_manifest(self):
+        """Манифест последнего бэкапа этой базы или None, если инкремент делать не от чего"""
+        filename = get_setting('last_backup_file')
+        if not filename:
+            return None
+        filepath = os.path.join(self.backup_dir, filename)
+        return read_backup_manifest(filepath) if os.path.exists(filepath) else None
+    
+    def resolve_chain(self, filepath):
+        """Файлы для восстановления: полный бэкап и инкременты до filepath включительно"""
+        chain = [filepath]
+        manifest = read_backup_manifest(filepath)
+        
+        while manifest and manifest['type'] == 'incremental':
+            parent = os.path.join(self.backup_dir, manifest['parent'])
+            manifest = read_backup_manifest(parent) if os.path.exists(parent) else None
+            if manifest is None:
+                raise ValueError(f"В цепочке не хватает бэкапа {os.path.basename(parent)}")
+            chain.insert(0, parent)
+        
+        return chain
+    
+    def load_index(self):
+        """Бэкапы из index.json, новые первыми (без индекса — один раз собирается по каталогу)"""
+        with self._index_lock:
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
             
-        except Exception as e:
-            print(f"❌ ОШИБКА в create_backup: {e}")
-            import traceback
-            traceback.print_exc()
-            await msg.edit_text(f"Ошибка: {str(e)[:200]}")
+            entries = self._scan_backups()
+            self._save_index(entries)
+            return entries
+    
+    def add_to_index(self, manifest):
+        """Добавить созданный бэкап в индекс"""
+        with self._index_lock:
+            entries = [entry for entry in self.load_index() if entry['file'] != manifest['file']]
+            self._save_index([manifest] + entries)
+    
+    def _scan_backups(self):
+        """Записи индекса по файлам в каталоге; у бэкапов без манифеста дата — время изменения файла"""
+        entries = []
+        paths = []
+        for extension in BACKUP_EXTENSIONS:
+            paths += glob.glob(os.path.join(self.backup_dir, f"*{extension}"))
+        
+        for path in paths:
+            filename = os.path.basename(path)
+            entry = read_backup_manifest(path) or {
+                'type': 'full',
+                'file': filename,
+                'base': filename,
+                'parent': None,
+                'created_at': datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).isoformat(),
+                'counts': {},
+                'legacy': True,
+            }
+            entry['size'] = os.path.getsize(path)
+            entries.append(entry)
+        
+        entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+        return entries
+    
+    def _save_index(self, entries):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+    
+    def apply_retention(self):
+        """Удалить бэкапы вне политики «дед-отец-сын»; вернуть (удалено файлов, освобождено байт)
+        
+        Из полных бэкапов остаются самый свежий и последний за каждый из BACKUP_KEEP_DAILY дней,
+        BACKUP_KEEP_WEEKLY недель и BACKUP_KEEP_MONTHLY месяцев. Инкременты остаются только
+        у полных бэкапов из дневного окна.
+        """
+        with self._index_lock:
+            return self._apply_retention(self.load_index())
+    
+    def _apply_retention(self, entries):
+        fulls = [entry for entry in entries if entry['type'] == 'full']
+        if not fulls:
+            return 0, 0
+        
+        def local_date(entry):
+            return datetime.fromisoformat(entry['created_at']).astimezone(BOT_TZ).date()
+        
+        def newest_per_period(period, limit):
+            """Самый свежий полный бэкап в каждом из последних limit периодов"""
+            kept = {}
+            for entry in fulls:
+                key = period(local_date(entry))
+                if key not in kept:
+                    if len(kept) >= limit:
+                        break
+                    kept[key] = entry['file']
+            return set(kept.values())
+        
+        daily = newest_per_period(lambda day: day, BACKUP_KEEP_DAILY)
+        weekly = newest_per_period(lambda day: day.isocalendar()[:2], BACKUP_KEEP_WEEKLY)
+        monthly = newest_per_period(lambda day: (day.year, day.month), BACKUP_KEEP_MONTHLY)
+        
+        with_increments = {fulls[0]['file']} | daily
+        keep = with_increments | weekly | monthly
+        
+        for entry in entries:
+            if entry['type'] == 'incremental' and entry['base'] in with_increments:
+                keep.add(entry['file'])
+        
+        deleted = 0
+        freed = 0
+        for entry in entries:
+            if entry['file'] in keep:
+                continue
+            path = os.path.join(self.backup_dir, entry['file'])
+            for file_path in (path, path + '.json'):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+            deleted += 1
+            freed += entry.get('size', 0)
+        
+        if deleted:
+            self._save_index([entry for entry in entries if entry['file'] in keep])
+        return deleted, freed
     
     async def show_backups(self, update: Update, context: CallbackContext):
         """Показать список доступных бэкапов с кнопками"""
@@ -683,8 +2697,9 @@ class SimpleBackup:
             await update.message.reply_text("❌ Доступ запрещен")
             return
         
-        backups = glob.glob(os.path.join(self.backup_dir, "*.sql.gz"))
-        backups.sort(key=os.path.getmtime, reverse=True)
+        # Список — из index.json, без обхода каталога
+        entries = (await run_backup_io(self.load_index))[:5]
+        backups = [os.path.join(self.backup_dir, entry['file']) for entry in entries]
         
         if not backups:
             await update.message.reply_text("Бэкапов нет", reply_markup=get_backup_menu_keyboard())
@@ -693,12 +2708,24 @@ class SimpleBackup:
         text = "Доступные бэкапы:\n\n"
         keyboard = []
         
-        for i, backup in enumerate(backups[:5], 1):
-            name = os.path.basename(backup)[7:-7]
-            size = os.path.getsize(backup) / (1024 * 1024)
-            date = datetime.fromtimestamp(os.path.getmtime(backup)).strftime('%d.%m %H:%M')
+        for i, entry in enumerate(entries, 1):
+            name = backup_label(entry['file'])
+            size = entry.get('size', 0) / (1024 * 1024)
+            date = format_datetime(datetime.fromisoformat(entry['created_at']), '%d.%m %H:%M')
             text += f"{i}. {name} ({size:.1f} MB) - {date}\n"
             
+            # Число строк — из манифеста, архив не открывается
+            counts = entry.get('counts') or {}
+            if entry['type'] == 'incremental':
+                text += f"   ➕ инкремент, база: {backup_label(entry['base'])}\n"
+                if counts:
+                    text += (
+                        f"   📊 изменений: {counts.get('users', 0)} польз., {counts.get('reputation', 0)} отзывов, "
+                        f"{counts.get('reputation_deletions', 0)} удалений\n"
+                    )
+            elif counts:
+                text += f"   📊 {counts.get('users', 0)} польз., {counts.get('reputation', 0)} отзывов\n"
+            
             # Добавляем инлайн-кнопку для каждого бэкапа
             keyboard.append([InlineKeyboardButton(
                 f"Восстановить {i}", 
@@ -734,8 +2761,19 @@ class SimpleBackup:
             context.user_data['restore_file'] = backup_file
             
             filename = os.path.basename(backup_file)
-            size = os.path.getsize(backup_file) / (1024 * 1024)
-            date = datetime.fromtimestamp(os.path.getmtime(backup_file)).strftime('%d.%m %H:%M')
+            try:
+                stat = await run_backup_io(os.stat, backup_file)
+                chain = await run_backup_io(self.resolve_chain, backup_file)
+            except FileNotFoundError:
+                await update.effective_message.reply_text("Файл не найден", reply_markup=get_backup_menu_keyboard())
+                return
+            except ValueError as e:
+                await update.effective_message.reply_text(f"❌ {e}", reply_markup=get_backup_menu_keyboard())
+                return
+            size = stat.st_size / (1024 * 1024)
+            date = datetime.fromtimestamp(stat.st_mtime).strftime('%d.%m %H:%M')
+            if len(chain) > 1:
+                filename += f"\nЦепочка: полный бэкап + {len(chain) - 1} инкрементов"
             
             # Используем инлайн-кнопки для подтверждения
             keyboard = [
@@ -780,43 +2818,47 @@ class SimpleBackup:
         else:
             message = update.message
         
-        if not backup_file or not os.path.exists(backup_file):
+        if not backup_file or not await run_backup_io(os.path.exists, backup_file):
             await message.reply_text("Файл не найден", reply_markup=get_backup_menu_keyboard())
             context.user_data.pop('restore_file', None)
             return
         
         msg = await message.reply_text("Восстановление...")
         
+        restored = False
         try:
-            with gzip.open(backup_file, 'rt', encoding='utf-8') as f:
-                sql_content = f.read()
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            sql_commands = sql_content.split(';')
-            
-            for cmd in sql_commands:
-                cmd = cmd.strip()
-                if cmd and not cmd.startswith('--'):
-                    try:
-                        cursor.execute(cmd)
-                    except Exception as e:
-                        print(f"Ошибка SQL: {cmd[:50]}... - {e}")
+            # Плановый бэкап или проверка не должны читать базу и файлы цепочки посреди восстановления
+            async with self._backup_lock:
+                chain = await run_backup_io(self.resolve_chain, backup_file)
+                progress = BackupProgress(msg, "Восстановление")
+                counts = await progress.track(run_backup_io(self.restore_chain, chain, progress))
+            restored = True
+            print(f"✅ Восстановлено из {backup_file}: {counts}")
             
-            conn.commit()
-            conn.close()
+            # Восстановленные отзывы — пересчитываем счётчики и сбрасываем кэши
+            await run_db_heavy(rebuild_reputation_counters)
+            await run_db_heavy(rebuild_reputation_daily)
+            profile_cache.clear()
+            user_write_buffer.forget_known()
+            await update_leaderboards()
             
-            await msg.edit_text("✅ База восстановлена")
+            await msg.edit_text(
+                f"✅ База восстановлена\n\n"
+                f"Пользователей: {counts.get('users', 0)}\n"
+                f"Отзывов: {counts.get('reputation', 0)}"
+            )
             await message.reply_text("Меню:", reply_markup=get_backup_menu_keyboard())
             
         except Exception as e:
-            await msg.edit_text(f"❌ Ошибка: {str(e)[:200]}")
+            print(f"❌ Ошибка восстановления из {backup_file}: {e}")
+            note = "" if restored else "\n\nБаза не изменена"
+            await msg.edit_text(f"❌ Ошибка: {str(e)[:200]}{note}")
         
         context.user_data.pop('restore_file', None)
         context.user_data.pop('backups_list', None)
     
     async def auto_cleanup(self, update: Update, context: CallbackContext):
-        """Автоочистка старых бэкапов"""
+        """Автоочистка старых бэкапов по политике хранения"""
         user_id = update.effective_user.id
         
         if user_id not in ADMINS:
@@ -824,57 +2866,24 @@ class SimpleBackup:
             return
         
         try:
-            backups = glob.glob(os.path.join(self.backup_dir, "*.sql.gz"))
-            backups.sort(key=os.path.getmtime, reverse=True)
+            deleted_count, freed_space = await run_backup_io(self.apply_retention)
             
-            if len(backups) <= 1:
+            if deleted_count == 0:
                 await update.message.reply_text(
                     "Нет старых бэкапов для очистки",
                     reply_markup=get_backup_menu_keyboard()
                 )
                 return
             
-            deleted_count = 0
-            freed_space = 0
-            
-            for old_backup in backups[1:]:
-                try:
-                    size = os.path.getsize(old_backup)
-                    os.remove(old_backup)
-                    deleted_count += 1
-                    freed_space += size
-                except:
-                    pass
-            
-            if deleted_count > 0:
-                freed_mb = freed_space / (1024 * 1024)
-                
-                # Получаем информацию об оставшемся бэкапе
-                remaining_backup = backups[0] if backups else None
-                if remaining_backup and os.path.exists(remaining_backup):
-                    remaining_size = os.path.getsize(remaining_backup) / (1024 * 1024)
-                    remaining_name = os.path.basename(remaining_backup)
-                    
-                    await update.message.reply_text(
-                        f"Автоочистка выполнена\n\n"
-                        f"Удалено: {deleted_count} файлов\n"
-                        f"Освобождено: {freed_mb:.1f} MB\n\n"
-                        f"Оставлен бэкап:\n"
-                        f"{remaining_name} ({remaining_size:.1f} MB)",
-                        reply_markup=get_backup_menu_keyboard()
-                    )
-                else:
-                    await update.message.reply_text(
-                        f"Автоочистка выполнена\n\n"
-                        f"Удалено: {deleted_count} файлов\n"
-                        f"Освобождено: {freed_mb:.1f} MB",
-                        reply_markup=get_backup_menu_keyboard()
-                    )
-            else:
-                await update.message.reply_text(
-                    "Не удалось удалить старые бэкапы",
-                    reply_markup=get_backup_menu_keyboard()
-                )
+            remaining = await run_backup_io(self.load_index)
+            await update.message.reply_text(
+                f"Автоочистка выполнена\n\n"
+                f"Удалено: {deleted_count} файлов\n"
+                f"Освобождено: {freed_space / (1024 * 1024):.1f} MB\n\n"
+                f"Осталось бэкапов: {len(remaining)}\n"
+                f"(по последнему за {BACKUP_KEEP_DAILY} дн., {BACKUP_KEEP_WEEKLY} нед., {BACKUP_KEEP_MONTHLY} мес.)",
+                reply_markup=get_backup_menu_keyboard()
+            )
                 
         except Exception as e:
             await update.message.reply_text(
@@ -882,10 +2891,101 @@ class SimpleBackup:
                 reply_markup=get_backup_menu_keyboard()
             )
 
+    async def verify_backup(self, update: Update, context: CallbackContext):
+        """Проверить последний бэкап восстановлением во временную схему"""
+        user_id = update.effective_user.id
+        
+        if user_id not in ADMINS:
+            await update.message.reply_text("❌ Доступ запрещен")
+            return
+        
+        msg = await update.message.reply_text("Проверка бэкапа...")
+        try:
+            progress = BackupProgress(msg, "Проверка бэкапа")
+            report = await progress.track(self.verify_latest(progress))
+            await msg.edit_text(format_verify_report(report) if report else "Бэкапов нет")
+        except Exception as e:
+            print(f"❌ Ошибка проверки бэкапа: {e}")
+            await msg.edit_text(f"❌ Ошибка проверки: {str(e)[:200]}")
+
+def format_verify_report(report):
+    """Текст отчёта о проверке бэкапа для админов"""
+    ok = not report['problems']
+    lines = [f"{'✅' if ok else '❌'} Проверка бэкапа {backup_label(report['file'])}: {'в порядке' if ok else 'есть ошибки'}"]
+    if report['chain'] > 1:
+        lines.append(f"Цепочка: полный бэкап + {report['chain'] - 1} инкрементов")
+    
+    counts = report.get('counts')
+    if counts:
+        lines.append(f"Восстановлено: {counts.get('users', 0)} пользователей, {counts.get('reputation', 0)} отзывов")
+    if report['sections']:
+        lines.append(f"Контрольные суммы: {report['sections']} секций совпали")
+    
+    live = report.get('live')
+    if live and live['match']:
+        lines.append(f"Отзывы до #{live['max_id']} совпадают с базой")
+    elif live:
+        lines.append(
+            f"⚠️ Отзывы до #{live['max_id']} отличаются от базы: в бэкапе {live['backup_rows']}, "
+            f"в базе {live['live_rows']} (удаления после бэкапа?)"
+        )
+    
+    for problem in report['problems']:
+        lines.append(f"• {problem}")
+    lines.append(f"Время: {report['seconds']:.1f} с")
+    return "\n".join(lines)
+
+def backup_age_hours(entry):
+    """Сколько часов назад создан бэкап из записи индекса"""
+    created_at = datetime.fromisoformat(entry['created_at'])
+    return (datetime.now(timezone.utc) - created_at).total_seconds() / 3600
+
+async def scheduled_backup_job(context: CallbackContext) -> None:
+    """Периодическая задача JobQueue: бэкап и очистка старых"""
+    try:
+        await backup_manager.run_scheduled()
+    except Exception as e:
+        print(f"❌ Ошибка планового бэкапа: {e}")
+        for admin_id in ADMINS:
+            try:
+                await context.bot.send_message(chat_id=admin_id, text=f"❌ Плановый бэкап не создан: {str(e)[:200]}")
+            except TelegramError:
+                pass
+
+async def scheduled_verify_job(context: CallbackContext) -> None:
+    """Периодическая задача JobQueue: проверка последнего бэкапа, отчёт админам"""
+    try:
+        report = await backup_manager.verify_latest()
+        if report is None:
+            return
+        text = format_verify_report(report)
+    except Exception as e:
+        print(f"❌ Ошибка проверки бэкапа: {e}")
+        text = f"❌ Проверка бэкапа не выполнена: {str(e)[:200]}"
+    
+    for admin_id in ADMINS:
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=text)
+        except TelegramError:
+            pass
+
 # Создаем глобальный объект для бэкапов
 backup_manager = SimpleBackup()
 
 # ========== ТЕЛЕГРАМ HANDLERS ==========
+async def top_command(update: Update, context: CallbackContext) -> None:
+    """Топ по репутации в чате: /top [day|week|month|all] (из снимка в памяти)"""
+    if update.message.chat.type == 'private':
+        return
+    
+    arg = context.args[0].lower() if context.args else 'week'
+    period = LEADERBOARD_ALIASES.get(arg)
+    if period is None:
+        await update.message.reply_text("Использование: /top [day|week|month|all]")
+        return
+    
+    await update.message.reply_text(format_leaderboard(period, limit=10), parse_mode='HTML')
+
 async def quick_profile(update: Update, context: CallbackContext) -> None:
     """Быстрый просмотр профиля в чате (собственный профиль)"""
     if update.message.chat.type == 'private':
@@ -894,17 +2994,17 @@ async def quick_profile(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
     
-    save_user(user_id, username)
+    await run_db(save_user, user_id, username)
     
-    user_info = get_user_info(user_id)
-    stats = get_reputation_stats(user_id)
+    profile = await run_db(get_profile_data, user_id)
+    user_info = profile['user_info']
+    stats = profile['stats']
     
     display_username = f"👤@{username}" if username else f"👤id{user_id}"
     
     if user_info and user_info.get("registered_at"):
         try:
-            reg_date = datetime.fromisoformat(user_info["registered_at"])
-            registration_date = reg_date.strftime("%d/%m/%Y")
+            registration_date = format_datetime(user_info["registered_at"], "%d/%m/%Y")
         except:
             registration_date = datetime.now().strftime("%d/%m/%Y")
     else:
@@ -949,18 +3049,18 @@ async def handle_fake_i_command(update: Update, context: CallbackContext):
         print(f"🔍 Без аргументов: показываем свой профиль")
         
         # Сохраняем пользователя если его нет в базе
-        save_user(target_user_id, target_username)
+        await run_db(save_user, target_user_id, target_username)
         
         # Показываем профиль
-        user_info = get_user_info(target_user_id)
-        stats = get_reputation_stats(target_user_id)
+        profile = await run_db(get_profile_data, target_user_id)
+        user_info = profile['user_info']
+        stats = profile['stats']
         
         display_username = f"👤@{target_username}" if target_username and not target_username.startswith('id') else f"👤id{target_user_id}"
         
         if user_info and user_info.get("registered_at"):
             try:
-                reg_date = datetime.fromisoformat(user_info["registered_at"])
-                registration_date = reg_date.strftime("%d/%m/%Y")
+                registration_date = format_datetime(user_info["registered_at"], "%d/%m/%Y")
             except:
                 registration_date = datetime.now().strftime("%d/%m/%Y")
         else:
@@ -997,7 +3097,7 @@ async def handle_fake_i_command(update: Update, context: CallbackContext):
         target_username = f"id{target_user_id}"
         
         # Проверяем, есть ли пользователь с таким ID в базе
-        user_info = get_user_info(target_user_id)
+        user_info = await run_db(get_user_info, target_user_id)
         if not user_info:
             await update.message.reply_text(
                 f"❌ <b>Пользователь с ID {target_user_id} не найден в базе</b>",
@@ -1012,7 +3112,7 @@ async def handle_fake_i_command(update: Update, context: CallbackContext):
         username = arg.lstrip('@')
         print(f"🔍 Ищем пользователя по username: @{username}")
         
-        user_info = get_user_by_username(username)
+        user_info = await run_db(get_user_by_username, username)
         
         if not user_info:
             # Пользователь не найден в базе
@@ -1032,10 +3132,11 @@ async def handle_fake_i_command(update: Update, context: CallbackContext):
     print(f"🎯 Показываем профиль пользователя: ID {target_user_id}, username: {target_username}")
     
     # Сохраняем пользователя если его нет в базе
-    save_user(target_user_id, target_username)
+    await run_db(save_user, target_user_id, target_username)
     
     # Получаем информацию о пользователе из базы
-    user_info = get_user_info(target_user_id)
+    profile = await run_db(get_profile_data, target_user_id)
+    user_info = profile['user_info']
     
     if not user_info:
         # Если пользователь все еще не найден (маловероятно, но на всякий случай)
@@ -1046,14 +3147,13 @@ async def handle_fake_i_command(update: Update, context: CallbackContext):
         return
     
     # Получаем статистику репутации
-    stats = get_reputation_stats(target_user_id)
+    stats = profile['stats']
     
     display_username = f"👤@{target_username}" if target_username and not target_username.startswith('id') else f"👤id{target_user_id}"
     
     if user_info and user_info.get("registered_at"):
         try:
-            reg_date = datetime.fromisoformat(user_info["registered_at"])
-            registration_date = reg_date.strftime("%d/%m/%Y")
+            registration_date = format_datetime(user_info["registered_at"], "%d/%m/%Y")
         except:
             registration_date = datetime.now().strftime("%d/%m/%Y")
     else:
@@ -1084,7 +3184,9 @@ async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
     
-    save_user(user_id, username)
+    await run_db(save_user, user_id, username)
+    # Написал боту — значит, снова доступен для рассылок
+    await run_db(mark_user_reachable, user_id)
     
     # Показываем клавиатуру админам
     if user_id in ADMINS:
@@ -1197,6 +3299,10 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         await backup_manager.create_backup(update, context)
         return
     
+    if text == "Инкрементальный бэкап":
+        await backup_manager.create_backup(update, context, incremental=True)
+        return
+    
     if text == "Показать бэкапы":
         await backup_manager.show_backups(update, context)
         return
@@ -1209,6 +3315,10 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         await backup_manager.auto_cleanup(update, context)
         return
     
+    if text == "Проверить бэкап":
+        await backup_manager.verify_backup(update, context)
+        return
+    
     if text == "✅ Да, восстановить":
         if 'restore_file' in context.user_data:
             await backup_manager.perform_restore(update, context)
@@ -1232,7 +3342,8 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         return
     
     if text == "Статистика":
-        stats = get_db_stats()
+        stats = await run_db_heavy(get_db_stats)
+        cache_stats = profile_cache.stats()
         message = f"""Статистика базы данных
 
 Пользователей: {stats.get('total_users', 0)}
@@ -1240,7 +3351,12 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
 Положительных: {stats.get('positive_reps', 0)}
 Отрицательных: {stats.get('negative_reps', 0)}
 Отправителей: {stats.get('unique_senders', 0)}
-Получателей: {stats.get('unique_receivers', 0)}"""
+Получателей: {stats.get('unique_receivers', 0)}
+
+Кэш профилей: {cache_stats['size']}/{profile_cache.max_size}
+Попаданий: {cache_stats['hits']}
+Промахов: {cache_stats['misses']}
+Доля попаданий: {cache_stats['hit_rate']:.0f}%"""
         
         await update.message.reply_text(
             message,
@@ -1248,6 +3364,18 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         )
         return
     
+    if text == "Пересчитать репутацию":
+        msg = await update.message.reply_text("Пересчёт счётчиков репутации...")
+        try:
+            users_count = await run_db_heavy(rebuild_reputation_counters)
+            await run_db_heavy(rebuild_reputation_daily)
+            await update_leaderboards()
+            await msg.edit_text(f"✅ Счётчики пересчитаны\n\nПользователей с отзывами: {users_count}")
+        except Exception as e:
+            print(f"❌ Ошибка пересчёта счётчиков: {e}")
+            await msg.edit_text(f"❌ Ошибка: {str(e)[:200]}")
+        return
+    
     if text == "Рассылка":
         context.user_data['admin_action'] = 'broadcast'
         await update.message.reply_text(
@@ -1265,8 +3393,7 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         return
     
     if text == "Топ за день":
-        top_data = get_daily_top(limit=15)
-        message = format_top_message(top_data, "за день")
+        message = format_leaderboard('day')
         await update.message.reply_text(
             message,
             reply_markup=get_top_menu_keyboard(),
@@ -1275,8 +3402,7 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         return
     
     if text == "Топ за неделю":
-        top_data = get_weekly_top(limit=15)
-        message = format_top_message(top_data, "за неделю")
+        message = format_leaderboard('week')
         await update.message.reply_text(
             message,
             reply_markup=get_top_menu_keyboard(),
@@ -1285,8 +3411,7 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         return
     
     if text == "Топ за месяц":
-        top_data = get_monthly_top(limit=15)
-        message = format_top_message(top_data, "за месяц")
+        message = format_leaderboard('month')
         await update.message.reply_text(
             message,
             reply_markup=get_top_menu_keyboard(),
@@ -1295,8 +3420,7 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
         return
     
     if text == "Топ за всё время":
-        top_data = get_all_time_top(limit=15)
-        message = format_top_message(top_data, "за всё время")
+        message = format_leaderboard('all')
         await update.message.reply_text(
             message,
             reply_markup=get_top_menu_keyboard(),
@@ -1319,7 +3443,7 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("❌ Ошибка: ID отзыва не найден", reply_markup=get_admin_menu_keyboard())
             return
         
-        if delete_reputation_by_id(rep_id):
+        if await run_db(delete_reputation_by_id, rep_id):
             message = f"✅ Отзыв #{rep_id} успешно удален"
         else:
             message = f"❌ Ошибка при удалении отзыва #{rep_id}"
@@ -1347,43 +3471,20 @@ async def handle_admin_menu(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("❌ Текст рассылки не найден", reply_markup=get_admin_menu_keyboard())
             return
         
-        users = get_all_users()
-        total = len(users)
+        broadcast_id, total = await run_db(create_broadcast, broadcast_text, user_id)
         
         if total == 0:
+            await run_db(finish_broadcast, broadcast_id)
             await update.message.reply_text("❌ Нет пользователей для рассылки", reply_markup=get_admin_menu_keyboard())
             return
         
-        progress_msg = await update.message.reply_text(f"Начинаю рассылку... 0/{total}")
-        
-        success = 0
-        failed = 0
-        
-        for i, user in enumerate(users):
-            try:
-                await context.bot.send_message(
-                    chat_id=user['user_id'],
-                    text=broadcast_text
-                )
-                success += 1
-            except Exception as e:
-                failed += 1
-            
-            if i % 10 == 0 or i == total - 1:
-                try:
-                    await progress_msg.edit_text(
-                        f"Рассылка... {i+1}/{total}\n"
-                        f"Успешно: {success}\n"
-                        f"Ошибок: {failed}"
-                    )
-                except:
-                    pass
+        # Рассылка идёт в фоне: бот продолжает отвечать, прогресс приходит отдельным сообщением
+        broadcast_engine.start(context.application, broadcast_id)
         
         await update.message.reply_text(
-            f"✅ Рассылка завершена!\n\n"
-            f"Всего пользователей: {total}\n"
-            f"Отправлено: {success}\n"
-            f"Не отправлено: {failed}\n\n"
+            f"✅ Рассылка #{broadcast_id} запущена\n\n"
+            f"Получателей: {total}\n"
+            f"Скорость: до {BROADCAST_RATE:.0f} сообщ./с\n\n"
             f"Текст рассылки:\n{broadcast_text[:200]}{'...' if len(broadcast_text) > 200 else ''}",
             reply_markup=get_admin_menu_keyboard()
         )
@@ -1427,8 +3528,8 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
         
         context.user_data['broadcast_text'] = text.strip()
         
-        users = get_all_users()
-        total = len(users)
+        total = await run_db(count_users, reachable_only=True)
+        skipped = await run_db(count_users) - total
         
         preview = text.strip()
         if len(preview) > 100:
@@ -1437,7 +3538,8 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(
             f"Предпросмотр рассылки\n\n"
             f"{text.strip()}\n\n"
-            f"Отправить {total} пользователям?\n\n"
+            f"Отправить {total} пользователям?\n"
+            f"(пропущено недоступных: {skipped})\n\n"
             f"Текст ({len(text.strip())} символов):\n{preview}",
             reply_markup=ReplyKeyboardMarkup([
                 ['✅ Да, отправить', '❌ Нет, отменить']
@@ -1459,7 +3561,7 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("❌ Максимум 3650 дней (10 лет)")
             return
         
-        top_data = get_top_users_by_period(days=days, limit=15)
+        top_data = await run_db(get_top_users_by_period, days=days, limit=15)
         
         if not top_data:
             await update.message.reply_text(
@@ -1504,7 +3606,7 @@ async def handle_admin_input(update: Update, context: CallbackContext) -> None:
 
 async def show_user_reputations_for_deletion(update: Update, user_id: int):
     """Показать отзывы пользователя с кнопками удаления"""
-    reps = get_reputations_by_user_id(user_id)
+    reps = await run_db(get_reputations_by_user_id, user_id)
     
     if not reps:
         await update.message.reply_text(
@@ -1514,14 +3616,14 @@ async def show_user_reputations_for_deletion(update: Update, user_id: int):
         return
     
     for i, rep in enumerate(reps[:10]):
-        rep_type = get_reputation_type(rep["text"])
+        rep_type = rep["polarity"]
         type_emoji = "🪄"
         
         short_text = rep['text']
         if len(short_text) > 50:
             short_text = short_text[:47] + "..."
         
-        date = datetime.fromisoformat(rep["created_at"]).strftime("%d/%m/%Y")
+        date = format_datetime(rep["created_at"], "%d/%m/%Y")
         
         if rep['to_user'] == user_id:
             direction = f"Получил от {rep['from_username']}"
@@ -1570,11 +3672,11 @@ async def handle_admin_callback(update: Update, context: CallbackContext) -> Non
         
         context.user_data['rep_to_delete'] = rep_id
         
-        rep_data = get_reputation_by_id(rep_id)
+        rep_data = await run_db(get_reputation_by_id, rep_id)
         if rep_data:
-            rep_type = get_reputation_type(rep_data["text"])
+            rep_type = rep_data["polarity"]
             type_text = "Положительный" if rep_type == '+' else "Отрицательный"
-            date = datetime.fromisoformat(rep_data["created_at"]).strftime("%d/%m/%Y %H:%M")
+            date = format_datetime(rep_data["created_at"], "%d/%m/%Y %H:%M")
             
             message = f"""Отзыв #{rep_id} ({type_text})
 
@@ -1600,12 +3702,12 @@ async def handle_admin_callback(update: Update, context: CallbackContext) -> Non
     elif data.startswith('admin_view_rep_'):
         rep_id = int(data.replace('admin_view_rep_', ''))
         
-        rep_data = get_reputation_by_id(rep_id)
+        rep_data = await run_db(get_reputation_by_id, rep_id)
         if rep_data and rep_data['photo_id']:
-            rep_type = get_reputation_type(rep_data["text"])
+            rep_type = rep_data["polarity"]
             type_text = "Положительный отзыв" if rep_type == '+' else "Отрицательный отзыв"
             
-            date = datetime.fromisoformat(rep_data["created_at"]).strftime("%d/%m/%Y %H:%M")
+            date = format_datetime(rep_data["created_at"], "%d/%m/%Y %H:%M")
             
             caption = f"""<b>{type_text}</b>
 
@@ -1669,16 +3771,16 @@ ID: {rep_data['from_user'] if rep_data['from_user'] else "Неизвестно"}
 # ========== ОСТАЛЬНЫЕ ФУНКЦИИ ==========
 async def show_profile_with_working_buttons(update: Update, target_user_id: int, context: CallbackContext):
     """Показать профиль пользователя с кнопками при переходе из чата"""
-    user_info = get_user_info(target_user_id)
-    stats = get_reputation_stats(target_user_id)
+    profile = await run_db(get_profile_data, target_user_id)
+    user_info = profile['user_info']
+    stats = profile['stats']
     
     username = user_info.get("username", "") if user_info else ""
     display_username = f"👤@{username}" if username else f"👤id{target_user_id}"
     
     if user_info and user_info.get("registered_at"):
         try:
-            reg_date = datetime.fromisoformat(user_info["registered_at"])
-            registration_date = reg_date.strftime("%d/%m/%Y")
+            registration_date = format_datetime(user_info["registered_at"], "%d/%m/%Y")
         except:
             registration_date = datetime.now().strftime("%d/%m/%Y")
     else:
@@ -1720,7 +3822,7 @@ async def show_reputation_photo(update: Update, rep_id: int, back_context: str,
     query = update.callback_query
     await query.answer()
     
-    rep_data = get_reputation_by_id(rep_id)
+    rep_data = await run_db(get_reputation_by_id, rep_id)
     if not rep_data:
         await query.answer("Отзыв не найден", show_alert=True)
         return
@@ -1731,13 +3833,13 @@ async def show_reputation_photo(update: Update, rep_id: int, back_context: str,
     if context.user_data.get('from_group') and target_user_id != current_user_id:
         back_context = 'back_from_group_view'
     
-    rep_type = get_reputation_type(rep_data["text"])
+    rep_type = rep_data["polarity"]
     type_text = "Положительный отзыв" if rep_type == '+' else "Отрицательный отзыв"
     
     from_username = rep_data["from_username"]
     user_id_display = rep_data["from_user"] if rep_data["from_user"] else "Неизвестно"
     
-    date = datetime.fromisoformat(rep_data["created_at"]).strftime("%d/%m/%Y %H:%M")
+    date = format_datetime(rep_data["created_at"], "%d/%m/%Y %H:%M")
     
     caption = f"""<b>{type_text}</b>
 
@@ -1781,21 +3883,75 @@ ID: {user_id_display}
             except Exception as e3:
                 print(f"❌ Ошибка редактирования текста: {e3}")
 
-async def show_my_reputation_menu(query, rep_type='all'):
-    """Показать меню репутации с кнопками для просмотра фото"""
+REP_TYPE_POLARITY = {'positive': '+', 'negative': '-'}
+REP_TYPE_CODES = {'all': 'a', 'positive': 'p', 'negative': 'n'}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def reputation_page_key(rep_type, direction, rep, page):
+    """Хвост callback_data листания: тип, направление, курсор (created_at, id) в микросекундах от эпохи, страница"""
+    created_us = (rep['created_at'] - EPOCH) // timedelta(microseconds=1)
+    return f"{REP_TYPE_CODES[rep_type]}_{direction}_{created_us}_{rep['id']}_{page}"
+
+def reputation_page_callback(prefix, rep_type, direction, rep, page):
+    """callback_data кнопки листания"""
+    return f"{prefix}_{reputation_page_key(rep_type, direction, rep, page)}"
+
+def reputation_return_key(rep_type, page_data, page):
+    """Хвост callback_data просмотра фото: по нему «Назад к списку» откроет ту же страницу"""
+    if page <= 1:
+        return rep_type
+    # Ключ сразу за первым отзывом страницы: «после» него страница начинается ровно с этого отзыва
+    first = page_data['reps'][0]
+    return reputation_page_key(rep_type, 'n', {'created_at': first['created_at'], 'id': first['id'] + 1}, page)
+
+def parse_reputation_page_callback(data):
+    """Разобрать callback_data листания: (префикс, тип, курсор для get_user_reputation_page, номер страницы)"""
+    prefix, type_code, direction, created_us, rep_id, page = data.rsplit('_', 5)
+    rep_type = next(name for name, code in REP_TYPE_CODES.items() if code == type_code)
+    key = (EPOCH + timedelta(microseconds=int(created_us)), int(rep_id))
+    page_cursor = {'after': key} if direction == 'n' else {'before': key}
+    return prefix, rep_type, page_cursor, int(page)
+
+def reputation_page_buttons(prefix, rep_type, page_data, page):
+    """Кнопки «назад/вперёд» для страницы отзывов"""
+    reps = page_data['reps']
+    buttons = []
+    
+    if page_data['has_prev'] and reps:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Назад",
+            callback_data=reputation_page_callback(prefix, rep_type, 'p', reps[0], page - 1)
+        ))
+    
+    if page_data['has_next'] and reps:
+        buttons.append(InlineKeyboardButton(
+            "Вперёд ➡️",
+            callback_data=reputation_page_callback(prefix, rep_type, 'n', reps[-1], page + 1)
+        ))
+    
+    return buttons
+
+def format_reputation_page_footer(page, total):
+    """Подпись под страницей отзывов"""
+    pages = max(1, -(-total // REPUTATION_PAGE_SIZE))
+    return f"\nСтраница {page} из {pages} · всего {total} отзывов"
+
+async def show_my_reputation_menu(query, rep_type='all', page_cursor=None, page=1):
+    """Показать меню репутации с кнопками для просмотра фото (постранично)"""
     user_id = query.from_user.id
-    stats = get_reputation_stats(user_id)
     
     if rep_type == 'positive':
-        filtered_reps = [r for r in stats['all_reps'] if get_reputation_type(r["text"]) == '+']
         title = "Положительные отзывы"
     elif rep_type == 'negative':
-        filtered_reps = [r for r in stats['all_reps'] if get_reputation_type(r["text"]) == '-']
         title = "Отрицательные отзывы"
     else:
-        filtered_reps = stats['all_reps']
         title = "Все отзывы"
     
+    page_data = await run_db(
+        get_user_reputation_page, user_id, REP_TYPE_POLARITY.get(rep_type), **(page_cursor or {})
+    )
+    filtered_reps = page_data['reps']
+    
     if not filtered_reps:
         text = f"{title}\n\n📭 Отзывов пока нет"
         keyboard = [[InlineKeyboardButton("↩️ Назад", callback_data='my_reputation')]]
@@ -1821,11 +3977,13 @@ async def show_my_reputation_menu(query, rep_type='all'):
     text = f"<b>{title}</b>\n\n"
     keyboard = []
     
-    for i, rep in enumerate(filtered_reps[:10], 1):
-        rep_type_char = get_reputation_type(rep["text"])
+    first_number = (page - 1) * REPUTATION_PAGE_SIZE + 1
+    return_key = reputation_return_key(rep_type, page_data, page)
+    for i, rep in enumerate(filtered_reps, first_number):
+        rep_type_char = rep["polarity"]
         emoji = "🪄"
         from_user = rep.get("from_username", f"id{rep['from_user']}")
-        date = datetime.fromisoformat(rep["created_at"]).strftime("%d/%m/%Y")
+        date = format_datetime(rep["created_at"], "%d/%m/%Y")
         
         short_text = rep['text']
         if len(short_text) > 40:
@@ -1837,11 +3995,14 @@ async def show_my_reputation_menu(query, rep_type='all'):
         
         keyboard.append([InlineKeyboardButton(
             f"{i}. {from_user} - {date}",
-            callback_data=f"view_photo_{rep['id']}_{rep_type}"
+            callback_data=f"view_photo_{rep['id']}_{return_key}"
         )])
     
-    if len(filtered_reps) > 10:
-        text += f"\n... и еще {len(filtered_reps) - 10} отзывов"
+    text += format_reputation_page_footer(page, page_data['total'])
+    
+    nav_buttons = reputation_page_buttons('rp', rep_type, page_data, page)
+    if nav_buttons:
+        keyboard.append(nav_buttons)
     
     keyboard.append([InlineKeyboardButton("↩️ Назад", callback_data='my_reputation')])
     
@@ -1864,23 +4025,23 @@ async def show_my_reputation_menu(query, rep_type='all'):
             parse_mode='HTML'
         )
 
-async def show_found_user_reputation_menu(query, target_user_id, rep_type='all'):
-    """Показать меню репутации найденного пользователя"""
-    user_info = get_user_info(target_user_id)
+async def show_found_user_reputation_menu(query, target_user_id, rep_type='all', page_cursor=None, page=1):
+    """Показать меню репутации найденного пользователя (постранично)"""
+    user_info = await run_db(get_user_info, target_user_id)
     username = user_info.get("username", "") if user_info else f"id{target_user_id}"
     
-    stats = get_reputation_stats(target_user_id)
-    
     if rep_type == 'positive':
-        filtered_reps = [r for r in stats['all_reps'] if get_reputation_type(r["text"]) == '+']
         title = f"Положительные отзывы @{username}"
     elif rep_type == 'negative':
-        filtered_reps = [r for r in stats['all_reps'] if get_reputation_type(r["text"]) == '-']
         title = f"Отрицательные отзывы @{username}"
     else:
-        filtered_reps = stats['all_reps']
         title = f"Все отзывы @{username}"
     
+    page_data = await run_db(
+        get_user_reputation_page, target_user_id, REP_TYPE_POLARITY.get(rep_type), **(page_cursor or {})
+    )
+    filtered_reps = page_data['reps']
+    
     if not filtered_reps:
         text = f"{title}\n\n📭 Отзывов пока нет"
         keyboard = [[InlineKeyboardButton("↩️ Назад", callback_data='view_found_user_reputation')]]
@@ -1906,11 +4067,13 @@ async def show_found_user_reputation_menu(query, target_user_id, rep_type='all')
     text = f"<b>{title}</b>\n\n"
     keyboard = []
     
-    for i, rep in enumerate(filtered_reps[:10], 1):
-        rep_type_char = get_reputation_type(rep["text"])
+    first_number = (page - 1) * REPUTATION_PAGE_SIZE + 1
+    return_key = reputation_return_key(rep_type, page_data, page)
+    for i, rep in enumerate(filtered_reps, first_number):
+        rep_type_char = rep["polarity"]
         emoji = "🪄"
         from_user = rep.get("from_username", f"id{rep['from_user']}")
-        date = datetime.fromisoformat(rep["created_at"]).strftime("%d/%m/%Y")
+        date = format_datetime(rep["created_at"], "%d/%m/%Y")
         
         short_text = rep['text']
         if len(short_text) > 40:
@@ -1922,11 +4085,14 @@ async def show_found_user_reputation_menu(query, target_user_id, rep_type='all')
         
         keyboard.append([InlineKeyboardButton(
             f"{i}. {from_user} - {date}",
-            callback_data=f"found_view_photo_{rep['id']}_{rep_type}"
+            callback_data=f"found_view_photo_{rep['id']}_{return_key}"
         )])
     
-    if len(filtered_reps) > 10:
-        text += f"\n... и еще {len(filtered_reps) - 10} отзывов"
+    text += format_reputation_page_footer(page, page_data['total'])
+    
+    nav_buttons = reputation_page_buttons(f"rpf_{target_user_id}", rep_type, page_data, page)
+    if nav_buttons:
+        keyboard.append(nav_buttons)
     
     keyboard.append([InlineKeyboardButton("↩️ Назад", callback_data='view_found_user_reputation')])
     
@@ -1966,12 +4132,25 @@ async def button_handler(update: Update, context: CallbackContext) -> None:
         await handle_admin_callback(update, context)
         return
     
+    if query.data.startswith('rp_') or query.data.startswith('rpf_'):
+        prefix, rep_type, page_cursor, page = parse_reputation_page_callback(query.data)
+        if prefix == 'rp':
+            await show_my_reputation_menu(query, rep_type, page_cursor, page)
+        else:
+            target_user_id = int(prefix.replace('rpf_', ''))
+            await show_found_user_reputation_menu(query, target_user_id, rep_type, page_cursor, page)
+        return
+    
     if query.data.startswith('view_photo_'):
-        parts = query.data.split('_')
-        if len(parts) >= 4:
+        parts = query.data.split('_', 3)
+        if len(parts) == 4:
             rep_id = int(parts[2])
-            rep_type = parts[3]
-            back_context = f"back_to_list_{rep_type}"
+            return_key = parts[3]
+            # Первая страница — тип списка, дальше — курсор страницы в формате rp_
+            if return_key in REP_TYPE_CODES:
+                back_context = f"back_to_list_{return_key}"
+            else:
+                back_context = f"rp_{return_key}"
             await show_reputation_photo(update, rep_id, back_context, context)
         return
     
@@ -1989,14 +4168,19 @@ async def button_handler(update: Update, context: CallbackContext) -> None:
         return
     
     if query.data.startswith('found_view_photo_'):
-        parts = query.data.split('_')
-        if len(parts) >= 5:
+        parts = query.data.split('_', 4)
+        if len(parts) == 5:
             rep_id = int(parts[3])
-            rep_type = parts[4]
+            return_key = parts[4]
+            target_user_id = context.user_data.get('found_user_id', 0)
             if context.user_data.get('from_group'):
                 back_context = 'back_from_group_view'
+            elif return_key in REP_TYPE_CODES:
+                back_context = f"found_back_to_list_{return_key}_{target_user_id}"
+            elif target_user_id:
+                back_context = f"rpf_{target_user_id}_{return_key}"
             else:
-                back_context = f"found_back_to_list_{rep_type}_{context.user_data.get('found_user_id', 0)}"
+                back_context = 'back_from_group_view'
             
             await show_reputation_photo(update, rep_id, back_context, context)
         return
@@ -2155,10 +4339,10 @@ async def handle_last_reputation(query, is_positive=True, is_own=True):
     user_id = query.from_user.id if is_own else query.message.chat.id
     
     if is_positive:
-        rep_data = get_last_positive(user_id)
+        rep_data = await run_db(get_last_positive, user_id)
         title = "Последний положительный отзыв"
     else:
-        rep_data = get_last_negative(user_id)
+        rep_data = await run_db(get_last_negative, user_id)
         title = "Последний отрицательный отзыв"
     
     if not rep_data:
@@ -2180,8 +4364,8 @@ async def handle_last_reputation(query, is_positive=True, is_own=True):
         return
     
     from_username = rep_data.get("from_username", f"id{rep_data['from_user']}")
-    date = datetime.fromisoformat(rep_data["created_at"]).strftime("%d/%m/%Y %H:%M")
-    rep_type = get_reputation_type(rep_data["text"])
+    date = format_datetime(rep_data["created_at"], "%d/%m/%Y %H:%M")
+    rep_type = rep_data["polarity"]
     
     text = f"""<b>{title}</b>
 
@@ -2219,16 +4403,16 @@ async def handle_old_button_logic(query, context):
 
 async def show_profile_pm(query, user_id, is_own_profile=True):
     """Показать профиль в личных сообщениях"""
-    user_info = get_user_info(user_id)
-    stats = get_reputation_stats(user_id)
+    profile = await run_db(get_profile_data, user_id)
+    user_info = profile['user_info']
+    stats = profile['stats']
     
     username = user_info.get("username", "") if user_info else ""
     display_username = f"👤@{username}" if username else f"👤id{user_id}"
     
     if user_info and user_info.get("registered_at"):
         try:
-            reg_date = datetime.fromisoformat(user_info["registered_at"])
-            registration_date = reg_date.strftime("%d/%m/%Y")
+            registration_date = format_datetime(user_info["registered_at"], "%d/%m/%Y")
         except:
             registration_date = datetime.now().strftime("%d/%m/%Y")
     else:
@@ -2326,12 +4510,13 @@ async def handle_all_messages(update: Update, context: CallbackContext) -> None:
         admin_menu_commands = [
             "Удалить отзыв", "Статистика", "Рассылка", "Главное меню",
             "Резервное копирование", "Назад в админ-панель",
-            "Создать бэкап", "Показать бэкапы", "Восстановить", "Автоочистка",
+            "Создать бэкап", "Инкрементальный бэкап", "Показать бэкапы", "Восстановить", "Автоочистка",
+            "Проверить бэкап",
             "✅ Да, удалить", "❌ Нет", "❌ Отмена",
             "✅ Да, отправить", "❌ Нет, отменить",
             "✅ Да, восстановить", "❌ Нет, отменить",
             "Топ по репутации", "Топ за день", "Топ за неделю", "Топ за месяц",
-            "Топ за всё время", "Топ за N дней"
+            "Топ за всё время", "Топ за N дней", "Пересчитать репутацию"
         ]
         
         if text in admin_menu_commands:
@@ -2342,15 +4527,16 @@ async def handle_all_messages(update: Update, context: CallbackContext) -> None:
             await handle_admin_input(update, context)
             return
     
+    # Пользователи пишутся в БД пачкой в фоне и только если они новые или сменили username
     if update.message.from_user:
-        save_user(update.message.from_user.id, update.message.from_user.username or "")
+        user_write_buffer.note(update.message.from_user.id, update.message.from_user.username or "")
     
     if update.message.reply_to_message and update.message.reply_to_message.from_user:
         reply_user = update.message.reply_to_message.from_user
-        save_user(reply_user.id, reply_user.username or "")
+        user_write_buffer.note(reply_user.id, reply_user.username or "")
     
     if update.message.forward_from:
-        save_user(update.message.forward_from.id, update.message.forward_from.username or "")
+        user_write_buffer.note(update.message.forward_from.id, update.message.forward_from.username or "")
     
     if update.message.chat.type == 'private':
         if context.user_data.get('waiting_for_search'):
@@ -2392,11 +4578,11 @@ async def handle_group_reputation(update: Update, context: CallbackContext) -> N
     print(f"📷 Есть фото: {bool(update.message.photo)}")
     print(f"{'='*60}")
     
-    is_rep_command = is_reputation_command(text)
+    command = parse_reputation(text)
     
-    print(f"🔍 Поиск +rep/-rep: {'НАЙДЕНО' if is_rep_command else 'НЕ НАЙДЕНО'}")
+    print(f"🔍 Поиск +rep/-rep: {'НАЙДЕНО' if command else 'НЕ НАЙДЕНО'}")
     
-    if not is_rep_command:
+    if not command:
         print(f"❌ Не команда репутации - игнорируем")
         return
     
@@ -2407,23 +4593,10 @@ async def handle_group_reputation(update: Update, context: CallbackContext) -> N
     
     print(f"✅ Фото есть, продолжаем обработку")
     
-    target_identifier = None
-    
-    patterns = [
-        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*@?([a-zA-Z0-9_]+)',
-        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*(\d+)',
-        r'@?([a-zA-Z0-9_]+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
-        r'(\d+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
-    ]
-    
-    for i, pattern in enumerate(patterns):
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            target_identifier = match.group(1)
-            print(f"🔍 Паттерн {i+1} совпал: {target_identifier}")
-            break
+    start, end = command.span
+    print(f"🔍 Команда: '{text[start:end]}', цель: {command.username or command.user_id}")
     
-    if not target_identifier:
+    if command.username is None and command.user_id is None:
         if update.message.reply_to_message:
             print(f"🔍 Используем реплай для определения пользователя")
             target_user = update.message.reply_to_message.from_user
@@ -2435,13 +4608,13 @@ async def handle_group_reputation(update: Update, context: CallbackContext) -> N
     else:
         target_info = {"id": None, "username": None}
         
-        if target_identifier.isdigit():
-            target_info["id"] = int(target_identifier)
-            target_info["username"] = f"id{target_identifier}"
+        if command.user_id is not None:
+            target_info["id"] = command.user_id
+            # username по ID неизвестен: None не затирает сохранённый в базе
             print(f"🔍 Найден ID: {target_info['id']}")
         else:
-            username_search = target_identifier.lstrip('@')
-            user_info = get_user_by_username(username_search)
+            username_search = command.username
+            user_info = await run_db(get_user_by_username, username_search)
             
             if user_info:
                 target_info["id"] = user_info['user_id']
@@ -2461,15 +4634,21 @@ async def handle_group_reputation(update: Update, context: CallbackContext) -> N
     
     print(f"💾 Сохраняем репутацию...")
     
-    save_reputation(
+    saved = await run_db(
+        save_reputation,
         from_user=from_user_id,
         from_username=from_username,
         to_user=target_info["id"],
         to_username=target_info["username"],
         text=text,
-        photo_id=update.message.photo[-1].file_id
+        photo_id=update.message.photo[-1].file_id,
+        polarity=command.polarity
     )
     
+    if not saved:
+        await update.message.reply_text("❌ <b>Не удалось сохранить репутацию</b>\nПопробуйте ещё раз", parse_mode='HTML')
+        return
+    
     print(f"✅ Репутация успешно сохранена!")
     
     await update.message.reply_text("✅ <b>Репутация сохранена</b>", parse_mode='HTML')
@@ -2487,33 +4666,18 @@ async def handle_reputation_message_pm(update: Update, context: CallbackContext)
         await update.message.reply_text("❌ <b>Добавьте текст к фото!</b>\n\nПример: +rep @username сделка прошла успешно", parse_mode='HTML')
         return
     
-    patterns = [
-        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*@?([a-zA-Z0-9_]+)',
-        r'[+-]\s*(?:rep|реп|рп)[\s:;,.-]*(\d+)',
-        r'@?([a-zA-Z0-9_]+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
-        r'(\d+)[\s:;,.-]*[+-]\s*(?:rep|реп|рп)',
-    ]
-    
-    target_identifier = None
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            target_identifier = match.group(1)
-            break
+    command = parse_reputation(text)
     
-    if not target_identifier:
+    if not command or (command.username is None and command.user_id is None):
         await update.message.reply_text("❌ <b>Неверный формат</b>\n\nИспользуйте: +rep @username или -rep @username", parse_mode='HTML')
         return
     
     target_info = {"id": None, "username": None}
     
-    if target_identifier.isdigit():
-        target_info["id"] = int(target_identifier)
-        target_info["username"] = f"id{target_identifier}"
+    if command.user_id is not None:
+        target_info["id"] = command.user_id
     else:
-        username = target_identifier.lstrip('@')
-        user_info = get_user_by_username(username)
+        user_info = await run_db(get_user_by_username, command.username)
         if user_info:
             target_info["id"] = user_info['user_id']
             target_info["username"] = user_info['username']
@@ -2525,15 +4689,21 @@ async def handle_reputation_message_pm(update: Update, context: CallbackContext)
         await update.message.reply_text("❌ <b>Нельзя отправлять репутацию самому себе</b>", parse_mode='HTML')
         return
     
-    save_reputation(
+    saved = await run_db(
+        save_reputation,
         from_user=user_id,
         from_username=update.effective_user.username or "",
         to_user=target_info["id"],
         to_username=target_info["username"],
         text=text,
-        photo_id=update.message.photo[-1].file_id
+        photo_id=update.message.photo[-1].file_id,
+        polarity=command.polarity
     )
     
+    if not saved:
+        await update.message.reply_text("❌ <b>Не удалось сохранить репутацию</b>\n\nПопробуйте ещё раз", parse_mode='HTML')
+        return
+    
     await update.message.reply_text("✅ <b>Репутация сохранена!</b>", parse_mode='HTML')
     await show_main_menu_from_message(update, context, user_id)
 
@@ -2564,10 +4734,10 @@ async def handle_search_message_pm(update: Update, context: CallbackContext) ->
     target_user = None
     
     if search_text.isdigit():
-        target_user = get_user_info(int(search_text))
+        target_user = await run_db(get_user_info, int(search_text))
     else:
         username = search_text.lstrip('@')
-        target_user = get_user_by_username(username)
+        target_user = await run_db(get_user_by_username, username)
     
     if not target_user:
         await update.message.reply_text("❌ <b>Пользователь не найден</b>", parse_mode='HTML')
@@ -2575,14 +4745,13 @@ async def handle_search_message_pm(update: Update, context: CallbackContext) ->
     
     context.user_data['found_user_id'] = target_user['user_id']
     
-    stats = get_reputation_stats(target_user['user_id'])
+    stats = (await run_db(get_profile_data, target_user['user_id']))['stats']
     username = target_user.get("username", "")
     display_username = f"👤@{username}" if username else f"👤id{target_user['user_id']}"
     
     if target_user.get("registered_at"):
         try:
-            reg_date = datetime.fromisoformat(target_user["registered_at"])
-            registration_date = reg_date.strftime("%d/%m/%Y")
+            registration_date = format_datetime(target_user["registered_at"], "%d/%m/%Y")
         except:
             registration_date = datetime.now().strftime("%d/%m/%Y")
     else:
@@ -2609,6 +4778,51 @@ async def handle_search_message_pm(update: Update, context: CallbackContext) ->
     context.user_data.pop('waiting_for_search', None)
 
 # ========== ЗАПУСК БОТА ==========
+async def on_startup(app: Application) -> None:
+    """Фоновые задачи после старта приложения"""
+    user_write_buffer.start()
+
+    # Последние снимки топов доступны сразу, до первого пересчёта
+    try:
+        LEADERBOARDS.update(await run_db(load_leaderboards))
+    except Exception as e:
+        print(f"❌ Ошибка загрузки топов: {e}")
+
+    # Рассылки, прерванные перезапуском, продолжаются с места остановки
+    try:
+        await broadcast_engine.resume_all(app)
+    except Exception as e:
+        print(f"❌ Ошибка продолжения рассылок: {e}")
+
+    if app.job_queue is None:
+        print("⚠️ JobQueue недоступна (нужен python-telegram-bot[job-queue]), топы не обновляются")
+    else:
+        app.job_queue.run_repeating(refresh_leaderboards_job, interval=LEADERBOARD_REFRESH_INTERVAL, first=1)
+        
+        if BACKUP_INTERVAL_HOURS > 0:
+            # Частые перезапуски не должны плодить бэкапы: первый — когда подойдёт срок
+            interval = BACKUP_INTERVAL_HOURS * 3600
+            entries = await run_backup_io(backup_manager.load_index)
+            first = interval - backup_age_hours(entries[0]) * 3600 if entries else 0
+            app.job_queue.run_repeating(scheduled_backup_job, interval=interval, first=max(first, 60))
+        
+        if BACKUP_VERIFY_INTERVAL_HOURS > 0:
+            interval = BACKUP_VERIFY_INTERVAL_HOURS * 3600
+            first = interval
+            last_verify = await run_db(get_setting, 'last_backup_verify')
+            if last_verify:
+                first -= (datetime.now(timezone.utc) - datetime.fromisoformat(last_verify)).total_seconds()
+            app.job_queue.run_repeating(scheduled_verify_job, interval=interval, first=max(first, 300))
+
+async def on_stop(app: Application) -> None:
+    """Остановить рассылки сразу после остановки приёма обновлений"""
+    await broadcast_engine.stop()
+
+async def on_shutdown(app: Application) -> None:
+    """Дописать отложенные данные перед остановкой"""
+    await user_write_buffer.stop()
+    print(f"✅ Пользователи записаны: {user_write_buffer.written}, пропущено без изменений: {user_write_buffer.skipped}")
+
 def main():
     """Основная функция запуска"""
     print("=" * 60)
@@ -2619,21 +4833,28 @@ def main():
     print(f"✅ DATABASE_URL: {'Установлен' if DATABASE_URL else 'Отсутствует!'}")
     print(f"✅ URL фото: {PHOTO_URL}")
     print(f"✅ Админы: {len(ADMINS)} пользователей")
+    print(f"✅ Пул БД: {DB_POOL_MIN}-{DB_POOL_MAX} соединений, потоков: {DB_WORKERS} + {DB_HEAVY_WORKERS}")
     
+    # Инициализация БД (до проверки: на пустой базе таблиц ещё нет)
     print("\n🔍 Проверка базы данных...")
-    check_database_connection()
+    if not init_db() or not check_database_connection():
+        sys.exit(1)
     
     print(f"\n✅ Резервное копирование: Добавлено")
     print(f"   - Создание бэкапов (Python версия)")
     print(f"   - Восстановление из бэкапов (Python версия)")
     print(f"   - Автоочистка")
+    if BACKUP_WORKERS > 1 and BACKUP_POOL_HEADROOM < BACKUP_WORKERS:
+        print(f"⚠️ Параллельная выгрузка: BACKUP_WORKERS={BACKUP_WORKERS}, но свободных соединений в пуле "
+              f"{BACKUP_POOL_HEADROOM} — увеличьте DB_POOL_MAX до {DB_POOL_MAX - BACKUP_POOL_HEADROOM + BACKUP_WORKERS}")
+    if BACKUP_INTERVAL_HOURS > 0:
+        print(f"   - По расписанию: каждые {BACKUP_INTERVAL_HOURS:g} ч, полный раз в {BACKUP_FULL_INTERVAL_HOURS:g} ч")
+    if BACKUP_VERIFY_INTERVAL_HOURS > 0:
+        print(f"   - Проверка последнего бэкапа: каждые {BACKUP_VERIFY_INTERVAL_HOURS:g} ч")
     print(f"   - Инлайн-кнопки для выбора")
     
-    # Инициализация БД
-    init_db()
-    
     # Создаем приложение бота
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build()
     
     # Команды для личных сообщений
     app.add_handler(CommandHandler("start", start))
@@ -2641,6 +4862,7 @@ def main():
     # Команды для чатов (групп)
     # Команды для чатов (групп)
     app.add_handler(CommandHandler("i", quick_profile))
+    app.add_handler(CommandHandler("top", top_command))
     app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^/и\b'), handle_fake_i_command))
     
     # Обработчики кнопок
@@ -2654,10 +4876,13 @@ def main():
     print("=" * 60)
     
     # Запускаем бота с сбросом старых обновлений
-    app.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True
-    )
+    try:
+        app.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+    finally:
+        shutdown_db()
 
 if __name__ == '__main__':
     main()
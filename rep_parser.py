@@ -0,0 +1,40 @@
+"""Разбор команд репутации (+rep / -rep) в тексте сообщения"""
+import re
+from collections import namedtuple
+
+# Команда — знак, слово rep/реп/рп и не буква/цифра после него, затем, возможно, цель:
+# @username или ID. Выражение начинается со знака, поэтому поиск не перебирает каждое слово текста
+REP_COMMAND_RE = re.compile(
+    r'(?P<sign>[+-])[\s:;-]*(?:rep|реп|рп)(?![a-zа-я0-9])(?:[\s:;,.-]*@?(?P<target>[a-z0-9_]+))?',
+    re.IGNORECASE
+)
+# Цель перед командой («@username +rep»): ищется только в тексте до команды
+REP_TARGET_BEFORE_RE = re.compile(r'@?([a-z0-9_]+)[\s:;,.-]*\Z', re.IGNORECASE)
+
+# polarity: '+' или '-'; username (без @) или user_id — цель из текста, если она есть;
+# span: (начало, конец) команды вместе с целью
+RepCommand = namedtuple('RepCommand', 'polarity username user_id span')
+
+
+def parse_reputation(text):
+    """Первая команда репутации в тексте (RepCommand) или None"""
+    # Быстрый путь: в большинстве сообщений группы нет ни плюса, ни минуса
+    if not text or ('+' not in text and '-' not in text):
+        return None
+
+    match = REP_COMMAND_RE.search(text)
+    if not match:
+        return None
+
+    # Цель после команды важнее цели перед ней: «@a +rep @b» — отзыв для b
+    start, end = match.span()
+    target = match.group('target')
+    if not target:
+        before = REP_TARGET_BEFORE_RE.search(text, 0, start)
+        if before:
+            target = before.group(1)
+            start = before.start()
+
+    if target and target.isdigit():
+        return RepCommand(match.group('sign'), None, int(target), (start, end))
+    return RepCommand(match.group('sign'), target, None, (start, end))